@@ -1,5 +1,22 @@
 import asyncio
-import queue
+import collections
+import functools
+import heapq
+import itertools
+import json
+import math
+import random
+import selectors
+import struct
+import sys
+import threading
+import time
+import types
+import warnings
+import zlib
+from concurrent.futures import (
+    ProcessPoolExecutor,
+)
 
 try:
     import contextvars
@@ -7,95 +24,1675 @@ try:
     def create_callback(when, callback, args, loop, context):
         return asyncio.TimerHandle(when, callback, args, loop, context=context)
 
+    _copy_context = contextvars.copy_context
+
 except ImportError:
     def create_callback(when, callback, args, loop, _):
         return asyncio.TimerHandle(when, callback, args, loop)
 
+    def _copy_context():
+        return None
+
+
+_inf = float('inf')
+
+# Held so they are unaffected by patch_time
+_real_monotonic = time.monotonic
+_real_perf_counter = time.perf_counter
+_real_time = time.time
+_real_sleep = time.sleep
+
+# Executor jobs that take at least this many real seconds are reported
+_REAL_TIME_LEAK_MIN_SECONDS = 0.005
+
+# How often, in real seconds, to check for a deadlock when waiting for I/O,
+# executor jobs or the loop's own timers
+_DEADLOCK_CHECK_INTERVAL = 0.05
+
+# The _scheduled of handles in FastForward's queues, rather than the True the
+# loop sets for its own timers, so a cancelled handle is routed without
+# searching the loop's heap
+_QUEUED = object()
+
+# How long, in real seconds, autojump waits for I/O or executor jobs to
+# complete before jumping
+_AUTOJUMP_WAIT_FOR_WORK_INTERVAL = 0.05
+
+try:
+    _all_tasks = asyncio.all_tasks
+except AttributeError:
+    _all_tasks = asyncio.Task.all_tasks
+
 
 class FastForward():
 
-    def __init__(self, loop):
+    def __init__(self, loop, timers='heap', autojump=False, tracer=None, clock=None, patch_time=False,
+                 real_time_leaks=None, speed=None, recorder=None, compact_handles=False,
+                 detect_deadlocks=False):
+        if timers not in _timer_queues:
+            raise ValueError('timers must be one of {}'.format(', '.join(sorted(_timer_queues))))
+        if real_time_leaks not in (None, 'warn', 'virtual'):
+            raise ValueError("real_time_leaks must be one of None, 'warn', 'virtual'")
+        if speed is not None and speed <= 0:
+            raise ValueError('speed must be positive')
         self._loop = loop
+        self._timers = timers
+        self._autojump = autojump
+        self._tracer = tracer
+        self._shared_clock = clock
+        self._patch_time = patch_time
+        self._real_time_leaks = real_time_leaks
+        self._speed = speed
+        self._recorder = recorder
+        self._create_callback = _CompactTimerHandle if compact_handles else create_callback
+        self._detect_deadlocks = detect_deadlocks
 
     def __enter__(self):
         self._original_call_later = self._loop.call_later
         self._original_call_at = self._loop.call_at
         self._original_time = self._loop.time
+        self._original_timer_handle_cancelled = self._loop._timer_handle_cancelled
         self._original_sleep = asyncio.sleep
         self._loop.call_later = self._mocked_call_later
         self._loop.call_at = self._mocked_call_at
-        self._loop.time = self._mocked_time
+        self._loop.time = \
+            self._mocked_time if self._speed is None else \
+            self._mocked_scaled_time
+        self._loop._timer_handle_cancelled = self._mocked_timer_handle_cancelled
         asyncio.sleep = self._maybe_mocked_sleep
 
-        self._callbacks_queue = queue.PriorityQueue()
-        self._forwards_queue = queue.PriorityQueue()
-        self._target_time = 0.0
-        self._time = 0.0
+        self._callbacks_queue = _timer_queues[self._timers]()
+        self._forwards_queue = _TimerQueue()
+        self._clock = \
+            self._shared_clock if self._shared_clock is not None else \
+            Clock()
+        self._clock._add(self)
+        self._run_scheduled = False
+        self._autojump_handle = None
+        self._autojump_waited = False
+        self._scaled_real_time = _real_monotonic()
+        self._scaled_handle = None
+        self._periodic_timers = []
+        self._periodic_handle = None
+        self._periodic_running = False
+        self._deadlock_handle = None
+        self._executor_jobs = 0
+
+        self._timers_scheduled = 0
+        self._timers_fired = 0
+        self._timers_cancelled = 0
+        self._forwards_issued = 0
+        self._forwards_resolved = 0
+        self._callbacks_queue_peak_size = 0
+        self._forwards_queue_peak_size = 0
+        self._runs = 0
+        self._noop_runs = 0
+        self._periods_skipped = 0
+        self._real_start_time = _real_monotonic()
+        self._real_end_time = None
+
+        mocked_time_functions = {}
+        if self._patch_time:
+            mocked_time_functions.update(self._mocked_time_functions())
+        if self._real_time_leaks is not None:
+            mocked_time_functions[time.sleep] = self._mocked_thread_sleep
+        self._original_time_functions = {mocked: original for original, mocked in mocked_time_functions.items()}
+        _patch_references(mocked_time_functions)
+
+        self._thread_sleeps = set()
+        self._thread_sleeps_lock = threading.Lock()
+        self._thread_local = threading.local()
+        self._original_run_in_executor = self._loop.run_in_executor
+        if self._real_time_leaks == 'warn' or self._detect_deadlocks or self._autojump:
+            self._loop.run_in_executor = self._mocked_run_in_executor
         return self
 
-    def __exit__(self, *_, **__):
+    def __exit__(self, exc_type, *_, **__):
         self._loop.call_at = self._original_call_at
         self._loop.call_later = self._original_call_later
         self._loop.time = self._original_time
+        self._loop._timer_handle_cancelled = self._original_timer_handle_cancelled
         asyncio.sleep = self._original_sleep
+        self._loop.run_in_executor = self._original_run_in_executor
+        # Including references taken by modules imported since entering
+        _patch_references(self._original_time_functions)
+        with self._thread_sleeps_lock:
+            thread_sleeps, self._thread_sleeps = self._thread_sleeps, None
+        for thread_sleep in thread_sleeps:
+            thread_sleep.set()
+        self._clock._remove(self)
+        if self._autojump_handle is not None:
+            self._autojump_handle.cancel()
+        if self._scaled_handle is not None:
+            self._scaled_handle.cancel()
+        if self._deadlock_handle is not None:
+            self._deadlock_handle.cancel()
+        self._real_end_time = _real_monotonic()
+        if self._recorder is not None and exc_type is None:
+            self._recorder._finish()
 
     def __call__(self, forward_seconds):
-        self._target_time += forward_seconds
-        acheived_target = asyncio.Event()
-        callback = create_callback(self._target_time, acheived_target.set, (), self._loop, None)
+        target_time = self._clock._forward(forward_seconds)
+        acheived_target = self._loop.create_future()
+        callback = create_callback(target_time, _set_result_unless_cancelled, (acheived_target, None), self._loop, None)
         self._forwards_queue.put(callback)
-        self._run()
-        return acheived_target.wait()
+        self._forwards_issued += 1
+        self._forwards_queue_peak_size = max(self._forwards_queue_peak_size, len(self._forwards_queue))
+        if self._speed is None:
+            self._run()
+        else:
+            self._scaled_run()
+        self._clock._notify_others(self)
+        return acheived_target
+
+    async def ticks(self, interval, count=None):
+        # Moves time forward by interval before each iteration, as forward
+        # would, but with one queued entry reused for all the ticks
+        tick = _TickHandle()
+        try:
+            for _ in (itertools.count() if count is None else range(count)):
+                tick._when = self._clock._forward(interval)
+                tick._reached = False
+                self._forwards_queue.put(tick)
+                self._forwards_issued += 1
+                self._forwards_queue_peak_size = max(self._forwards_queue_peak_size, len(self._forwards_queue))
+                if self._speed is None:
+                    self._run()
+                else:
+                    self._scaled_run()
+                self._clock._notify_others(self)
+                if not tick._reached:
+                    tick._waiter = self._loop.create_future()
+                    await tick._waiter
+                    tick._waiter = None
+                yield tick._when
+        finally:
+            tick._cancelled = True
+
+    def stats(self):
+        real_end_time = \
+            self._real_end_time if self._real_end_time is not None else \
+            _real_monotonic()
+        return {
+            'timers_scheduled': self._timers_scheduled,
+            'timers_fired': self._timers_fired,
+            'timers_cancelled': self._timers_cancelled,
+            'forwards_issued': self._forwards_issued,
+            'forwards_resolved': self._forwards_resolved,
+            'callbacks_queue_size': len(self._callbacks_queue),
+            'callbacks_queue_peak_size': self._callbacks_queue_peak_size,
+            'forwards_queue_size': len(self._forwards_queue),
+            'forwards_queue_peak_size': self._forwards_queue_peak_size,
+            'runs': self._runs,
+            'noop_runs': self._noop_runs,
+            'periods_skipped': self._periods_skipped,
+            'virtual_time': self._clock._time,
+            'real_time': real_end_time - self._real_start_time,
+        }
+
+    def call_periodic(self, interval, callback, *args, skippable=False, pass_missed=False):
+        # Calls callback every interval seconds until cancelled. Periods of
+        # skippable timers with no other callback or forward between them are
+        # skipped, calling callback once, at the last of them
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        timer = PeriodicTimer(self, self._clock._time, interval, callback, args, skippable, pass_missed)
+        self._periodic_timers.append(timer)
+        self._arm_periodic()
+        return timer
+
+    def schedule_many(self, timers):
+        # Schedules an iterable of (when, callback, args), as call_at would
+        callbacks = [
+            self._create_callback(when, callback, args, self._loop, None)
+            for when, callback, args in timers
+        ]
+        if not callbacks:
+            return callbacks
+
+        self._callbacks_queue.put_many(callbacks)
+        self._clock._scheduled(self, min(callback._when for callback in callbacks))
+        self._timers_scheduled += len(callbacks)
+        self._callbacks_queue_peak_size = max(self._callbacks_queue_peak_size, len(self._callbacks_queue))
+        if self._tracer is not None:
+            for callback in callbacks:
+                self._tracer._scheduled(callback, self._clock._time)
+        if self._speed is not None:
+            self._scaled_arm()
+        self._dispatch()
+        return callbacks
+
+    async def run_until_idle(self):
+        # Repeatedly forward to the next callback, until there are no
+        # callbacks and the loop has nothing else to run
+        start_time = self._clock._time
+        while True:
+            await self._original_sleep(0)
+            if self._is_ready():
+                continue
+            if not self._callbacks_queue:
+                break
+            self._clock._target_time = max(self._clock._target_time, self._callbacks_queue.peek_when())
+            self._run()
+
+        return self._clock._time - start_time
+
+    async def until(self, predicate, limit=None):
+        # Moves time forward to each next callback in turn, checking the
+        # predicate once the callbacks at each time, and anything they cause
+        # to run, have run. Returns the time the predicate is first true
+        clock = self._clock
+        deadline = None if limit is None else clock._time + limit
+        while True:
+            await self._original_sleep(0)
+            if self._is_ready():
+                continue
+            if predicate():
+                return clock._time
+            if not self._callbacks_queue:
+                raise asyncio.TimeoutError('Predicate not true, and there are no callbacks that could make it so')
+
+            next_when = self._callbacks_queue.peek_when()
+            if deadline is not None and next_when > deadline:
+                raise asyncio.TimeoutError('Predicate not true within {} seconds'.format(limit))
+            clock._target_time = max(clock._target_time, next_when)
+            self._run()
 
     def _run(self):
+        clock = self._clock
+        callbacks_queue = self._callbacks_queue
+        forwards_queue = self._forwards_queue
+        self._runs += 1
+        progress_before = self._timers_fired + self._forwards_resolved
+
+        # Callbacks of other FastForwards sharing the clock must be called
+        # first if they are earlier, and they are considered when resolving
+        # forwards
+        others_next_when = clock._others_next_when(self)
+        next_when = _min_when(callbacks_queue.peek_when() if callbacks_queue else None, others_next_when)
+
         # Resolve all forwards strictly before first callback if there is one
-        while \
-                self._callbacks_queue.queue and self._forwards_queue.queue \
-                and self._forwards_queue.queue[0] <  self._callbacks_queue.queue[0]:
-            self._progress_time(self._forwards_queue)
+        while next_when is not None and forwards_queue and forwards_queue.peek_when() < next_when:
+            self._progress_time(forwards_queue)
+            self._forwards_resolved += 1
 
-        while self._callbacks_queue.queue and self._callbacks_queue.queue[0]._when <= self._target_time:
-            self._progress_time(self._callbacks_queue)
+        while \
+                callbacks_queue and callbacks_queue.peek_when() <= clock._target_time \
+                and (others_next_when is None or callbacks_queue.peek_when() <= others_next_when):
+            self._timers_fired += self._progress_time(callbacks_queue)
 
             # Resolve all forwards at this callback, if no more callbacks at time
             is_last_callback_at_time = \
-                not self._callbacks_queue.queue or \
-                self._callbacks_queue.queue[0]._when > self._time
+                (not callbacks_queue or callbacks_queue.peek_when() > clock._time) and \
+                (others_next_when is None or others_next_when > clock._time)
             if is_last_callback_at_time:
-                while self._forwards_queue.queue and self._forwards_queue.queue[0]._when <= self._time:
-                    self._progress_time(self._forwards_queue)
+                while forwards_queue and forwards_queue.peek_when() <= clock._time:
+                    self._progress_time(forwards_queue)
+                    self._forwards_resolved += 1
+
+        # Resolve all forwards reached by callbacks of other FastForwards
+        is_after_all_callbacks = \
+            clock._is_shared() and \
+            (not callbacks_queue or callbacks_queue.peek_when() > clock._time) and \
+            (others_next_when is None or others_next_when > clock._time)
+        if is_after_all_callbacks:
+            while forwards_queue and forwards_queue.peek_when() <= clock._time:
+                self._progress_time(forwards_queue)
+                self._forwards_resolved += 1
+
+        self._noop_runs += progress_before == self._timers_fired + self._forwards_resolved
+        clock._set_next_when(self, callbacks_queue.peek_when() if callbacks_queue else None)
+
+        if self._detect_deadlocks and forwards_queue and self._deadlock_handle is None:
+            self._deadlock_handle = self._loop.call_soon(self._check_deadlock)
+
+    def _check_deadlock(self):
+        # A forward can never complete if there are no callbacks, and nothing
+        # is ready to run or being waited for that could schedule some
+        self._deadlock_handle = None
+        if self._real_end_time is not None:
+            return
+        if not self._forwards_queue or self._callbacks_queue or self._clock._is_shared() or self._speed is not None:
+            return
+
+        if self._is_ready():
+            self._deadlock_handle = self._loop.call_soon(self._check_deadlock)
+            return
+
+        if self._is_waiting_for_work():
+            # The loop's own timers are in terms of the patched time, which
+            # doesn't move while idle, so can't be used to check again later
+            self._deadlock_handle = threading.Timer(
+                _DEADLOCK_CHECK_INTERVAL, self._loop.call_soon_threadsafe, (self._check_deadlock,))
+            self._deadlock_handle.daemon = True
+            self._deadlock_handle.start()
+            return
+
+        self._fail_forwards()
+
+    def _is_waiting_for_work(self):
+        # The loop's own timers aren't included, since they are also in terms
+        # of pseudo-time, so won't be called while it doesn't move
+        selector = getattr(self._loop, '_selector', None)
+        self_socket = getattr(self._loop, '_ssock', None)
+        return \
+            selector is None or self_socket is None or \
+            any(key.fd != self_socket.fileno() for key in selector.get_map().values()) or \
+            self._executor_jobs > 0
+
+    def _fail_forwards(self):
+        handles = []
+        while self._forwards_queue:
+            handle = self._forwards_queue.get()
+            if not handle._cancelled:
+                handles.append(handle)
+
+        tasks = [task for task in _all_tasks(self._loop) if not task.done()]
+        message = \
+            'Forward to {} can never complete: time is {}, there are no callbacks, and the loop has nothing ' \
+            'to run or wait for that could schedule some. Pending tasks:{}'.format(
+                handles[0]._when, self._clock._time,
+                ''.join('\n    {!r}'.format(task) for task in tasks) if tasks else ' none')
+        for handle in handles:
+            future = handle._waiter if isinstance(handle, _TickHandle) else handle._args[0]
+            if future is not None and not future.done():
+                future.set_exception(ForwardDeadlockError(message))
+
+    def _scaled_run(self):
+        # Moves time forward by the real time since the last call, multiplied
+        # by the speed. Unlike when not scaled, time passes even without
+        # callbacks, so forwards are then resolved up to the target
+        clock = self._clock
+        real_time = _real_monotonic()
+        clock._target_time += (real_time - self._scaled_real_time) * self._speed
+        self._scaled_real_time = real_time
+        self._run()
+
+        forwards_queue = self._forwards_queue
+        while forwards_queue and forwards_queue.peek_when() <= clock._target_time:
+            self._progress_time(forwards_queue)
+            self._forwards_resolved += 1
+        clock._time = max(clock._time, clock._target_time)
+
+        self._scaled_arm()
+
+    def _scaled_arm(self):
+        # Wakes the loop via its own scheduler when the next callback is due.
+        # The loop measures its timeouts with the patched time, so this is in
+        # terms of that, but for a delay that is in real seconds
+        if self._scaled_handle is not None:
+            self._scaled_handle.cancel()
+            self._scaled_handle = None
+        if not self._callbacks_queue:
+            return
+
+        self._scaled_when = self._callbacks_queue.peek_when()
+        now = self._mocked_scaled_time()
+        real_delay = max(0, self._scaled_when - now) / self._speed
+        self._scaled_handle = self._original_call_at(min(now + real_delay, self._scaled_when), self._scaled_run)
+
+    def _arm_periodic(self):
+        # All periodic timers are called from a single callback, so that
+        # skippable timers don't prevent each other from skipping
+        if self._periodic_running:
+            return
+        next_when = min((timer._next_when() for timer in self._periodic_timers), default=None)
+        if self._periodic_handle is not None:
+            if self._periodic_handle._when == next_when:
+                return
+            self._periodic_handle.cancel()
+            self._periodic_handle = None
+        if next_when is not None:
+            self._periodic_handle = self._mocked_call_at(next_when, self._run_periodic)
+
+    def _run_periodic(self):
+        self._periodic_handle = None
+        self._periodic_running = True
+        clock = self._clock
+        try:
+            while True:
+                # Periodic timers are called before any other callback, and no
+                # later than any forward or the target
+                before = _min_when(
+                    self._callbacks_queue.peek_when() if self._callbacks_queue else None,
+                    clock._others_next_when(self),
+                )
+                not_after = _min_when(
+                    clock._target_time,
+                    self._forwards_queue.peek_when() if self._forwards_queue else None,
+                )
+                # ... and skippable timers aren't skipped past non-skippable
+                skippable_before = _min_when(before, *(
+                    timer._next_when() for timer in self._periodic_timers if not timer._skippable
+                ))
+                due = [
+                    (timer._period_when(period), i, timer, period)
+                    for i, timer in enumerate(self._periodic_timers)
+                    for period in [timer._last_period(skippable_before if timer._skippable else before, not_after)]
+                    if period is not None
+                ]
+                if not due:
+                    break
+
+                when, _, timer, period = min(due)
+                clock._time = when
+                missed = period - timer._period
+                self._periods_skipped += missed
+                timer._period = period + 1
+                try:
+                    timer._run(missed)
+                except (SystemExit, KeyboardInterrupt):
+                    raise
+                except BaseException as exception:
+                    self._loop.call_exception_handler({
+                        'message': 'Exception in periodic callback {}'.format(_callback_name(timer._callback)),
+                        'exception': exception,
+                    })
+        finally:
+            self._periodic_running = False
+            self._arm_periodic()
+
+    def _run_scheduled_run(self):
+        # At most one of these is pending at any time, so timers scheduled in
+        # the same iteration of the loop are all dispatched in a single _run
+        self._run_scheduled = False
+        self._run()
+
+    def _autojump_if_idle(self):
+        # Checked once per iteration of the loop while there are callbacks.
+        # If nothing else is ready to run, the loop would otherwise wait, so
+        # move time forward to the next callback
+        self._autojump_handle = None
+        if self._real_end_time is not None or not self._callbacks_queue:
+            return
+
+        if self._is_ready():
+            self._autojump_waited = False
+            self._autojump_handle = self._loop.call_soon(self._autojump_if_idle)
+            return
+
+        # If waiting for I/O or executor jobs, they're given some real time to
+        # complete before jumping. The loop's own timers are in terms of the
+        # patched time, which doesn't move while idle, so can't be used
+        if self._is_waiting_for_work() and not self._autojump_waited:
+            self._autojump_waited = True
+            self._autojump_handle = threading.Timer(
+                _AUTOJUMP_WAIT_FOR_WORK_INTERVAL, self._loop.call_soon_threadsafe, (self._autojump_if_idle,))
+            self._autojump_handle.daemon = True
+            self._autojump_handle.start()
+            return
+
+        self._autojump_waited = False
+        self._clock._target_time = max(self._clock._target_time, self._callbacks_queue.peek_when())
+        self._run()
+        self._autojump_handle = self._loop.call_soon(self._autojump_if_idle)
+
+    def _is_ready(self):
+        # Whether the loop has anything to run other than FastForward's own
+        # idle checks, which would otherwise each wait for the other forever
+        autojump_handle = self._autojump_handle
+        deadlock_handle = self._deadlock_handle
+        return any(
+            handle is not autojump_handle and handle is not deadlock_handle
+            for handle in self._loop._ready
+        )
 
     def _progress_time(self, queue):
         callback = queue.get()
-        self._time = callback._when
-        if not callback._cancelled:
+        self._clock._time = callback._when
+        if callback._cancelled:
+            return False
+
+        if self._recorder is not None:
+            self._recorder._fired(callback)
+        if self._tracer is None:
             callback._run()
+        else:
+            start = _real_perf_counter()
+            callback._run()
+            self._tracer._fired(callback, self._clock._time, _real_perf_counter() - start)
+        return True
 
     def _mocked_call_later(self, delay, callback, *args, context=None):
-        when = self._time + delay
+        when = self._loop.time() + delay
         return self._mocked_call_at(when, callback, *args, context=context)
 
     def _mocked_call_at(self, when, callback, *args, context=None):
-        callback = create_callback(when, callback, args, self._loop, context)
-        self._callbacks_queue.put(callback)
-        self._original_call_at(0, self._run)
+        callback = self._create_callback(when, callback, args, self._loop, context)
+        self._schedule(callback)
         return callback
 
+    def _schedule(self, callback):
+        self._callbacks_queue.put(callback)
+        self._clock._scheduled(self, callback._when)
+        self._timers_scheduled += 1
+        self._callbacks_queue_peak_size = max(self._callbacks_queue_peak_size, len(self._callbacks_queue))
+        if self._tracer is not None:
+            self._tracer._scheduled(callback, self._clock._time)
+        if self._speed is not None and (self._scaled_handle is None or callback._when < self._scaled_when):
+            self._scaled_arm()
+        self._dispatch()
+
+    def _dispatch(self):
+        if not self._run_scheduled:
+            self._run_scheduled = True
+            # The loop's own timer at 0 is called after its ready callbacks,
+            # so due timers are called after call_soon callbacks, as asyncio
+            self._original_call_at(0, self._run_scheduled_run)
+        if self._autojump and self._autojump_handle is None:
+            self._autojump_handle = self._loop.call_soon(self._autojump_if_idle)
+
     def _mocked_time(self):
-        return self._time
+        return self._clock._time
+
+    def _mocked_scaled_time(self):
+        # Never past the next callback, which is called by the next _scaled_run
+        clock = self._clock
+        now = clock._target_time + (_real_monotonic() - self._scaled_real_time) * self._speed
+        if self._callbacks_queue:
+            now = min(now, self._callbacks_queue.peek_when())
+        return max(clock._time, now)
+
+    def _mocked_time_functions(self):
+        # The same as the loop's time, which moves with real time if scaled.
+        # Each is a distinct function, so can be mapped back to its original
+        loop_time = self._loop.time
+        wall_time_offset = _real_time() - loop_time()
+        mocked_functions = {
+            time.monotonic: lambda: loop_time(),
+            time.perf_counter: lambda: loop_time(),
+            time.time: lambda: wall_time_offset + loop_time(),
+        }
+        # The _ns functions were introduced in Python 3.7
+        if hasattr(time, 'monotonic_ns'):
+            mocked_functions.update({
+                time.monotonic_ns: lambda: int(loop_time() * 1000000000),
+                time.perf_counter_ns: lambda: int(loop_time() * 1000000000),
+                time.time_ns: lambda: int((wall_time_offset + loop_time()) * 1000000000),
+            })
+        return mocked_functions
+
+    def _mocked_thread_sleep(self, seconds):
+        # Blocking the loop's own thread can't be avoided, and other threads
+        # only wait in pseudo-time if real_time_leaks is 'virtual'
+        if self._real_time_leaks == 'warn' or threading.get_ident() == self._loop._thread_id:
+            warnings.warn(
+                'time.sleep({}) blocks for real time while time is fast-forwarded'.format(seconds),
+                RealTimeLeakWarning, stacklevel=2,
+            )
+            # Already reported, so not included in the time of executor jobs
+            start = _real_perf_counter()
+            try:
+                return _real_sleep(seconds)
+            finally:
+                self._thread_local.slept = getattr(self._thread_local, 'slept', 0.0) + _real_perf_counter() - start
+
+        # On exit, all pending thread sleeps are woken
+        thread_sleep = threading.Event()
+        with self._thread_sleeps_lock:
+            if self._thread_sleeps is None:
+                return _real_sleep(seconds)
+            self._thread_sleeps.add(thread_sleep)
+            self._loop.call_soon_threadsafe(self._mocked_call_later, seconds, thread_sleep.set)
+        thread_sleep.wait()
+
+    def _mocked_run_in_executor(self, executor, func, *args):
+        future = self._original_run_in_executor(executor, self._timed(func, executor), *args)
+        self._executor_jobs += 1
+        future.add_done_callback(self._executor_job_done)
+        return future
+
+    def _executor_job_done(self, _):
+        self._executor_jobs -= 1
+
+    def _timed(self, func, executor):
+        # Functions are pickled to run in other processes, so only threads
+        if self._real_time_leaks != 'warn' or isinstance(executor, ProcessPoolExecutor):
+            return func
+
+        def timed_func(*args):
+            start = _real_perf_counter()
+            slept_before = getattr(self._thread_local, 'slept', 0.0)
+            try:
+                return func(*args)
+            finally:
+                slept = getattr(self._thread_local, 'slept', 0.0) - slept_before
+                seconds = _real_perf_counter() - start - slept
+                if seconds >= _REAL_TIME_LEAK_MIN_SECONDS:
+                    warnings.warn(
+                        '{} took {:.3f} real seconds in an executor while time is fast-forwarded'.format(
+                            _callback_name(func), seconds),
+                        RealTimeLeakWarning,
+                    )
+
+        return timed_func
+
+    def _mocked_timer_handle_cancelled(self, handle):
+        if not handle._scheduled:
+            return
+
+        # The loop's own timers, scheduled before entering or by the original
+        # call_at, are in its heap rather than the callbacks queue
+        if handle._scheduled is not _QUEUED:
+            self._original_timer_handle_cancelled(handle)
+            return
+
+        self._timers_cancelled += 1
+        self._callbacks_queue.cancelled(handle)
+        if self._tracer is not None:
+            self._tracer._cancelled(handle, self._clock._time)
 
     async def _maybe_mocked_sleep(self, delay, result=None):
-        func = \
-            self._mocked_sleep if asyncio.get_event_loop() == self._loop else \
-            self._original_sleep
-        return await func(delay, result)
+        if _get_running_loop() is not self._loop:
+            return await self._original_sleep(delay, result)
+
+        # As asyncio.sleep, a non-positive delay just yields to the loop
+        if delay <= 0:
+            await _sleep0()
+            return result
+
+        future = self._loop.create_future()
+        handle = _SleepHandle(self._loop.time() + delay, future, result)
+        self._schedule(handle)
+        try:
+            return await future
+        finally:
+            # As asyncio.sleep, so a cancelled sleep is removed from the queue
+            handle.cancel(self)
+
+
+class RealTimeLeakWarning(RuntimeWarning):
+    pass
+
+
+class ForwardDeadlockError(RuntimeError):
+    pass
+
+
+def _patch_references(mocked_functions):
+    # Patches functions in the modules that define them, as well as any
+    # references to them that modules have taken via "from ... import ...".
+    # Restored by patching each mocked function back to its original
+    if not mocked_functions:
+        return
+
+    this_module = sys.modules[__name__]
+    for module in list(sys.modules.values()):
+        if module is None or module is this_module:
+            continue
+        try:
+            module_items = list(vars(module).items())
+        except TypeError:
+            continue
+        for name, value in module_items:
+            try:
+                mocked = mocked_functions.get(value)
+            except TypeError:
+                continue
+            if mocked is not None:
+                setattr(module, name, mocked)
+
+
+class PeriodicTimer():
+    # Returned by FastForward.call_periodic. Period n is due at start + n *
+    # interval, computed each time rather than accumulated, so doesn't drift
+
+    def __init__(self, fast_forward, start, interval, callback, args, skippable, pass_missed):
+        self._fast_forward = fast_forward
+        self._start = start
+        self._interval = interval
+        self._callback = callback
+        self._args = args
+        self._skippable = skippable
+        self._pass_missed = pass_missed
+        self._period = 1
+        self._cancelled = False
+
+    def cancel(self):
+        if not self._cancelled:
+            self._cancelled = True
+            self._fast_forward._periodic_timers.remove(self)
+            self._fast_forward._arm_periodic()
+
+    def cancelled(self):
+        return self._cancelled
+
+    def _run(self, missed):
+        if self._pass_missed:
+            self._callback(*self._args, missed)
+        else:
+            self._callback(*self._args)
+
+    def _period_when(self, period):
+        return self._start + period * self._interval
+
+    def _next_when(self):
+        return self._period_when(self._period)
+
+    def _last_period(self, before, not_after):
+        # The period to call the callback for if it's due: the next, or for
+        # skippable timers the last that is before and not after the limits
+        def is_due(period):
+            when = self._period_when(period)
+            return (before is None or when < before) and (not_after is None or when <= not_after)
+
+        if not is_due(self._period):
+            return None
+        if not self._skippable:
+            return self._period
+
+        limit = _min_when(before, not_after)
+        if limit is None:
+            return self._period
+        last_period = max(self._period, math.floor((limit - self._start) / self._interval))
+        while not is_due(last_period):
+            last_period -= 1
+        while is_due(last_period + 1):
+            last_period += 1
+        return last_period
+
+
+class Resource():
+    # An operation that takes cost seconds, of which at most concurrency can be
+    # in progress at once, with the rest waiting in order. Takes pseudo-time
+    # via asyncio.sleep, so can simulate a database or remote service. Accepts
+    # and ignores any arguments, so can replace an async function
+
+    def __init__(self, cost, concurrency=None, result=None):
+        if concurrency is not None and concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        self._cost = cost
+        self._concurrency = concurrency
+        self._result = result
+        self._in_use = 0
+        self._waiters = collections.deque()
+        self._operations = 0
+        self._peak_in_use = 0
+        self._peak_waiting = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._busy_time = 0.0
+
+    async def __call__(self, *_, **__):
+        loop = asyncio.get_event_loop()
+        start_time = loop.time()
+        await self._acquire(loop)
+        wait_time = loop.time() - start_time
+        self._total_wait_time += wait_time
+        self._max_wait_time = max(self._max_wait_time, wait_time)
+        try:
+            cost = self._cost() if callable(self._cost) else self._cost
+            await asyncio.sleep(cost)
+            self._busy_time += cost
+            self._operations += 1
+        finally:
+            self._release()
+        return self._result
+
+    def stats(self):
+        return {
+            'operations': self._operations,
+            'in_use': self._in_use,
+            'waiting': len(self._waiters),
+            'peak_in_use': self._peak_in_use,
+            'peak_waiting': self._peak_waiting,
+            'total_wait_time': self._total_wait_time,
+            'max_wait_time': self._max_wait_time,
+            'busy_time': self._busy_time,
+        }
+
+    async def _acquire(self, loop):
+        if self._concurrency is None or (self._in_use < self._concurrency and not self._waiters):
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            return
+
+        # On release, the slot is handed directly to the first waiter
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        self._peak_waiting = max(self._peak_waiting, len(self._waiters))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def _release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._in_use -= 1
+
+
+class Network():
+    # In-memory equivalents of asyncio.start_server and open_connection, with
+    # bytes delivered via loop.call_at, so in pseudo-time. Each direction of
+    # each connection is a link that sends one write at a time at bandwidth
+    # bytes per second, which then arrives after latency plus up to jitter
+    # seconds, in order. Each lost write is resent after a round trip
+
+    def __init__(self, latency=0.0, bandwidth=None, jitter=0.0, loss=0.0, seed=None):
+        if bandwidth is not None and bandwidth <= 0:
+            raise ValueError('bandwidth must be positive')
+        if not 0 <= loss < 1:
+            raise ValueError('loss must be at least 0 and less than 1')
+        self._latency = latency
+        self._bandwidth = bandwidth
+        self._jitter = jitter
+        self._loss = loss
+        self._random = random.Random(seed)
+        self._servers = {}
+        self._ports = itertools.count(49152)
+
+    async def start_server(self, client_connected_cb, host='localhost', port=None, limit=2 ** 16):
+        port = next(self._ports) if port is None else port
+        if (host, port) in self._servers:
+            raise OSError('Address already in use: {}'.format((host, port)))
+        server = _VirtualServer(self, (host, port), client_connected_cb, limit)
+        self._servers[(host, port)] = server
+        return server
+
+    async def open_connection(self, host='localhost', port=None, limit=2 ** 16):
+        loop = asyncio.get_event_loop()
+        server = self._servers.get((host, port))
+        if server is None:
+            raise ConnectionRefusedError('Connection refused: {}'.format((host, port)))
+
+        # The handshake takes a round trip
+        await asyncio.sleep(2 * self._latency)
+
+        client_address = ('localhost', next(self._ports))
+        client_transport = _VirtualTransport(self, loop, client_address, server.address)
+        server_transport = _VirtualTransport(self, loop, server.address, client_address)
+        client_transport._peer = server_transport
+        server_transport._peer = client_transport
+
+        server_reader = asyncio.StreamReader(limit=server.limit, loop=loop)
+        server_protocol = asyncio.StreamReaderProtocol(server_reader, server.client_connected_cb, loop=loop)
+        server_transport._set_protocol(server_protocol)
+
+        reader = asyncio.StreamReader(limit=limit, loop=loop)
+        protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+        client_transport._set_protocol(protocol)
+        return reader, asyncio.StreamWriter(client_transport, protocol, reader, loop)
+
+    def _delivery_time(self, link_free_at, last_delivery, num_bytes, now):
+        sent = max(now, link_free_at)
+        if self._bandwidth is not None:
+            sent += num_bytes / self._bandwidth
+        delivery = sent + self._latency
+        while self._loss and self._random.random() < self._loss:
+            delivery += 2 * self._latency
+        if self._jitter:
+            delivery += self._random.uniform(0, self._jitter)
+        return sent, max(delivery, last_delivery)
+
+
+class _VirtualServer():
+
+    def __init__(self, network, address, client_connected_cb, limit):
+        self.address = address
+        self.client_connected_cb = client_connected_cb
+        self.limit = limit
+        self._network = network
+        self._closed = asyncio.Event()
+
+    def close(self):
+        if self._network._servers.get(self.address) is self:
+            del self._network._servers[self.address]
+        self._closed.set()
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        self.close()
+        await self.wait_closed()
+
+
+class _VirtualTransport(asyncio.Transport):
+
+    def __init__(self, network, loop, sockname, peername):
+        super().__init__(extra={'sockname': sockname, 'peername': peername})
+        self._network = network
+        self._loop = loop
+        self._peer = None
+        self._protocol = None
+        self._closing = False
+        self._connection_lost = False
+        self._paused = False
+        self._eof = False
+        self._received = collections.deque()
+        self._link_free_at = 0.0
+        self._last_delivery = 0.0
+        self._writing_paused = False
+        self._high_water = 64 * 1024
+        self._low_water = 16 * 1024
+
+    def _set_protocol(self, protocol):
+        self._protocol = protocol
+        protocol.connection_made(self)
+
+    def get_protocol(self):
+        return self._protocol
+
+    def is_closing(self):
+        return self._closing
+
+    def is_reading(self):
+        return not self._paused
+
+    def pause_reading(self):
+        self._paused = True
+
+    def resume_reading(self):
+        self._paused = False
+        self._process_received()
+
+    def get_write_buffer_size(self):
+        # Bytes written but not yet sent at the link's bandwidth
+        bandwidth = self._network._bandwidth
+        if bandwidth is None:
+            return 0
+        return max(0, round((self._link_free_at - self._loop.time()) * bandwidth))
+
+    def get_write_buffer_limits(self):
+        return (self._low_water, self._high_water)
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        # As asyncio's transports
+        if high is None:
+            high = 64 * 1024 if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError('high ({!r}) must be >= low ({!r}) must be >= 0'.format(high, low))
+        self._high_water = high
+        self._low_water = low
+        self._maybe_pause_writing()
+
+    def can_write_eof(self):
+        return True
+
+    def write(self, data):
+        if self._closing or not data:
+            return
+        now = self._loop.time()
+        self._link_free_at, self._last_delivery = self._network._delivery_time(
+            self._link_free_at, self._last_delivery, len(data), now)
+        self._loop.call_at(self._last_delivery, self._peer._receive, bytes(data))
+        self._maybe_pause_writing()
+
+    def write_eof(self):
+        if self._closing:
+            return
+        self._loop.call_at(self._after_last_delivery(), self._peer._receive, b'')
+
+    def close(self):
+        if self._closing:
+            return
+        self._closing = True
+        self._loop.call_at(self._after_last_delivery(), self._peer._receive, None)
+        self._loop.call_soon(self._lose_connection)
 
-    async def _mocked_sleep(self, delay, result):
-        future = asyncio.Future()
-        self._mocked_call_later(delay, _set_result_unless_cancelled, future, result)
-        return await future
+    def abort(self):
+        self.close()
+
+    def _maybe_pause_writing(self):
+        if not self._writing_paused and self.get_write_buffer_size() > self._high_water:
+            self._writing_paused = True
+            self._protocol.pause_writing()
+            self._loop.call_at(self._resume_writing_when(), self._maybe_resume_writing)
+
+    def _maybe_resume_writing(self):
+        # Writes while paused move the time the buffer drains to later
+        if self._connection_lost or not self._writing_paused:
+            return
+        resume_writing_when = self._resume_writing_when()
+        if self._loop.time() < resume_writing_when:
+            self._loop.call_at(resume_writing_when, self._maybe_resume_writing)
+            return
+        self._writing_paused = False
+        self._protocol.resume_writing()
+
+    def _resume_writing_when(self):
+        return self._link_free_at - self._low_water / self._network._bandwidth
+
+    def _after_last_delivery(self):
+        return max(self._loop.time() + self._network._latency, self._last_delivery)
+
+    def _receive(self, data):
+        # Data, b'' for EOF, or None for the peer closing, processed in order
+        # and only while reading isn't paused
+        self._received.append(data)
+        self._process_received()
+
+    def _process_received(self):
+        received = self._received
+        while received and not self._paused and not self._connection_lost:
+            data = received.popleft()
+            if data:
+                self._protocol.data_received(data)
+            elif data is not None:
+                self._eof_received()
+            else:
+                self._eof_received()
+                self._lose_connection()
+
+    def _eof_received(self):
+        if not self._eof:
+            self._eof = True
+            self._protocol.eof_received()
+
+    def _lose_connection(self):
+        if not self._connection_lost:
+            self._closing = True
+            self._connection_lost = True
+            self._protocol.connection_lost(None)
+
+
+class Clock():
+    # Pseudo-time, shared by all FastForwards created with it, even if their
+    # loops run in different threads. Each publishes when its next callback
+    # is, and only calls callbacks that are no later than all the others'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._time = 0.0
+        self._target_time = 0.0
+        self._next_whens = {}
+
+    def time(self):
+        return self._time
+
+    def _add(self, fast_forward):
+        with self._lock:
+            self._next_whens[fast_forward] = None
+
+    def _remove(self, fast_forward):
+        with self._lock:
+            del self._next_whens[fast_forward]
+        self._notify_others(fast_forward)
+
+    def _forward(self, forward_seconds):
+        with self._lock:
+            self._target_time += forward_seconds
+            return self._target_time
+
+    def _scheduled(self, fast_forward, when):
+        next_when = self._next_whens[fast_forward]
+        if next_when is None or when < next_when:
+            self._next_whens[fast_forward] = when
+
+    def _is_shared(self):
+        return len(self._next_whens) > 1
+
+    def _set_next_when(self, fast_forward, when):
+        if self._next_whens.get(fast_forward, when) != when:
+            self._next_whens[fast_forward] = when
+            self._notify_others(fast_forward)
+
+    def _others_next_when(self, fast_forward):
+        if not self._is_shared():
+            return None
+        with self._lock:
+            return _min_when(*(
+                next_when
+                for other, next_when in self._next_whens.items()
+                if other is not fast_forward
+            ))
+
+    def _notify_others(self, fast_forward):
+        if not self._is_shared():
+            return
+        with self._lock:
+            others = [other for other in self._next_whens if other is not fast_forward]
+        for other in others:
+            other._loop.call_soon_threadsafe(other._run)
+
+
+def _min_when(*whens):
+    return min((when for when in whens if when is not None), default=None)
+
+
+class Tracer():
+    # Records callbacks being scheduled, cancelled, and called, as Chrome
+    # trace events. Timestamps are in pseudo-time, but the durations of called
+    # callbacks are the real time they took
+
+    def __init__(self):
+        self.events = []
+
+    def write(self, f):
+        json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def _scheduled(self, handle, now):
+        self.events.append({
+            'name': _callback_name(handle._callback), 'cat': 'scheduled', 'ph': 'i', 's': 't',
+            'ts': now * 1000000, 'pid': 1, 'tid': 1, 'args': {'when': handle._when},
+        })
+
+    def _cancelled(self, handle, now):
+        self.events.append({
+            'name': _callback_name(handle._callback), 'cat': 'cancelled', 'ph': 'i', 's': 't',
+            'ts': now * 1000000, 'pid': 1, 'tid': 1, 'args': {'when': handle._when},
+        })
+
+    def _fired(self, handle, now, real_duration):
+        self.events.append({
+            'name': _callback_name(handle._callback), 'cat': 'fired', 'ph': 'X',
+            'ts': now * 1000000, 'dur': real_duration * 1000000, 'pid': 1, 'tid': 1,
+            'args': {'real_duration': real_duration},
+        })
+
+
+class Recorder():
+    # Records the time, name, and a fingerprint of the arguments of each
+    # callback called. If passed a file previously written by write, instead
+    # verifies that the same callbacks are called at the same times, raising
+    # ScheduleMismatchError at the first that isn't
+    #
+    # The file is the magic bytes, then a sequence of records, each either
+    # b'N' followed by the length and UTF-8 bytes of a callback name, given
+    # the next index, or b'E' followed by the time, name index, and
+    # fingerprint of a called callback
+
+    _MAGIC = b'AFFR\x01'
+    _NAME = struct.Struct('<H')
+    _EVENT = struct.Struct('<dII')
+
+    def __init__(self, expected=None):
+        self.events = []
+        self._expected = None if expected is None else self._read(expected)
+        self._mismatch = None
+
+    def write(self, f):
+        name_indexes = {}
+        f.write(self._MAGIC)
+        for when, name, fingerprint in self.events:
+            if name not in name_indexes:
+                name_indexes[name] = len(name_indexes)
+                name_bytes = name.encode('utf-8')
+                f.write(b'N' + self._NAME.pack(len(name_bytes)) + name_bytes)
+            f.write(b'E' + self._EVENT.pack(when, name_indexes[name], fingerprint))
+
+    @classmethod
+    def _read(cls, f):
+        data = f.read()
+        if not data.startswith(cls._MAGIC):
+            raise ValueError('Not a recording written by aiofastforward.Recorder')
+
+        names = []
+        events = []
+        offset = len(cls._MAGIC)
+        while offset < len(data):
+            kind = data[offset:offset + 1]
+            offset += 1
+            if kind == b'N':
+                length, = cls._NAME.unpack_from(data, offset)
+                offset += cls._NAME.size
+                names.append(data[offset:offset + length].decode('utf-8'))
+                offset += length
+            elif kind == b'E':
+                when, name_index, fingerprint = cls._EVENT.unpack_from(data, offset)
+                offset += cls._EVENT.size
+                events.append((when, names[name_index], fingerprint))
+            else:
+                raise ValueError('Unknown record type {!r} at byte {}'.format(kind, offset - 1))
+        return events
+
+    def _fired(self, handle):
+        event = (handle._when, _callback_name(handle._callback), _args_fingerprint(getattr(handle, '_args', ())))
+        index = len(self.events)
+        self.events.append(event)
+        if self._expected is None or self._mismatch is not None:
+            return
+
+        expected = self._expected[index] if index < len(self._expected) else None
+        if event != expected:
+            self._mismatch = ScheduleMismatchError(
+                'Event {} differs from the recording: expected {}, but was {}'.format(
+                    index, _describe_event(expected), _describe_event(event)))
+            raise self._mismatch
+
+    def _finish(self):
+        if self._expected is None:
+            return
+        if self._mismatch is not None:
+            raise self._mismatch
+        if len(self.events) < len(self._expected):
+            raise ScheduleMismatchError(
+                'Only {} of the {} recorded events happened: the first missing is {}'.format(
+                    len(self.events), len(self._expected), _describe_event(self._expected[len(self.events)])))
+
+
+class ScheduleMismatchError(AssertionError):
+    pass
+
+
+def _describe_event(event):
+    return \
+        'no event' if event is None else \
+        '{1} at {0!r} with arguments fingerprint {2:08x}'.format(*event)
+
+
+# Arguments of these types are fingerprinted by value, and all others only by
+# type, since their reprs can include memory addresses
+_FINGERPRINTED_TYPES = (type(None), bool, int, float, str, bytes)
+
+
+def _args_fingerprint(args):
+    return zlib.crc32('\0'.join(
+        repr(arg) if type(arg) in _FINGERPRINTED_TYPES else type(arg).__qualname__
+        for arg in args
+    ).encode('utf-8'))
+
+
+def _callback_name(callback):
+    # Names are compared across runs, so never include the repr of instances,
+    # which can include their address
+    if isinstance(callback, functools.partial):
+        callback = callback.func
+    if getattr(callback, '__qualname__', None) is None:
+        callback = type(callback)
+    module = getattr(callback, '__module__', None)
+    return \
+        callback.__qualname__ if module is None else \
+        module + '.' + callback.__qualname__
+
+
+class _TimerQueue():
+    # Min-heap of TimerHandles keyed on (when, sequence number), so handles due
+    # at the same time are run in the order they were scheduled. Only ever
+    # accessed from the loop's thread, so unlike queue.PriorityQueue, no locks.
+    #
+    # Put handles are only added to the heap when it's next read, so many put
+    # in the same iteration of the loop can be added with a single heapify
+
+    def __init__(self):
+        self._heap = []
+        self._unheaped = []
+        self._sequence = itertools.count()
+        self._cancelled_count = 0
+
+    def __bool__(self):
+        return bool(self._heap) or bool(self._unheaped)
+
+    def __len__(self):
+        return len(self._heap) + len(self._unheaped)
+
+    def put(self, handle):
+        handle._scheduled = _QUEUED
+        self._unheaped.append((handle._when, next(self._sequence), handle))
+
+    def put_many(self, handles):
+        sequence = self._sequence
+        for handle in handles:
+            handle._scheduled = _QUEUED
+        self._unheaped.extend((handle._when, next(sequence), handle) for handle in handles)
+
+    def get(self):
+        if self._unheaped:
+            self._heapify()
+        handle = heapq.heappop(self._heap)[2]
+        handle._scheduled = False
+        self._cancelled_count -= handle._cancelled
+        return handle
+
+    def cancelled(self, handle):
+        self._cancelled_count += 1
+        if _should_compact(len(self), self._cancelled_count):
+            self._heap, self._cancelled_count = _without_cancelled(self._heap + self._unheaped, handle)
+            self._unheaped = []
+            heapq.heapify(self._heap)
+
+    def peek_when(self):
+        if self._unheaped:
+            self._heapify()
+        return self._heap[0][0]
+
+    def _heapify(self):
+        # Pushing each is O(k log n), and heapifying all is O(n + k)
+        heap, unheaped = self._heap, self._unheaped
+        self._unheaped = []
+        if len(unheaped) * 4 < len(heap):
+            for entry in unheaped:
+                heapq.heappush(heap, entry)
+        else:
+            heap.extend(unheaped)
+            heapq.heapify(heap)
+
+
+class _TimerWheel():
+    # Hierarchical timing wheel of TimerHandles, with O(1) put. Handles are
+    # bucketed by tick, the number of whole resolutions since 0, into the level
+    # of the first 6-bit group of the tick that differs from the wheel's
+    # current tick. Handles at or before the current tick are in a
+    # (when, sequence number) heap, so the order they are got in is the same
+    # as from _TimerQueue. Handles at infinity are kept in a list
+
+    _level_bits = 6
+    _level_mask = (1 << _level_bits) - 1
+    _num_levels = 6
+
+    def __init__(self, resolution=0.001):
+        self._resolution = resolution
+        self._sequence = itertools.count()
+        self._tick = 0
+        self._len = 0
+        self._due = []
+        self._levels = [[[] for _ in range(1 << self._level_bits)] for _ in range(self._num_levels)]
+        self._occupied = [0] * self._num_levels  # Bitmask of non-empty slots per level
+        self._overflow = []
+        self._infinite = []
+        self._cancelled_count = 0
+
+    def __bool__(self):
+        return bool(self._len)
+
+    def __len__(self):
+        return self._len
+
+    def put(self, handle):
+        handle._scheduled = _QUEUED
+        self._len += 1
+        self._place((handle._when, next(self._sequence), handle))
+
+    def put_many(self, handles):
+        for handle in handles:
+            self.put(handle)
+
+    def get(self):
+        if not self._due:
+            self._advance()
+        self._len -= 1
+        handle = \
+            heapq.heappop(self._due)[2] if self._due else \
+            self._infinite.pop(0)[2]
+        handle._scheduled = False
+        self._cancelled_count -= handle._cancelled
+        return handle
+
+    def cancelled(self, handle):
+        self._cancelled_count += 1
+        if not _should_compact(self._len, self._cancelled_count):
+            return
+
+        entries = self._due + [
+            entry
+            for slots in self._levels
+            for slot in slots
+            for entry in slot
+        ] + [entry for _, entry in self._overflow] + self._infinite
+        entries, self._cancelled_count = _without_cancelled(entries, handle)
+
+        self._len = len(entries)
+        self._due = []
+        self._levels = [[[] for _ in range(1 << self._level_bits)] for _ in range(self._num_levels)]
+        self._occupied = [0] * self._num_levels
+        self._overflow = []
+        self._infinite = []
+        for entry in entries:
+            self._place(entry)
+
+    def peek_when(self):
+        if not self._due:
+            self._advance()
+        return \
+            self._due[0][0] if self._due else \
+            self._infinite[0][0]
+
+    def _place(self, entry):
+        try:
+            tick = int(entry[0] // self._resolution)
+        except (OverflowError, ValueError):
+            tick = entry[0]
+
+        if tick <= self._tick:
+            heapq.heappush(self._due, entry)
+            return
+
+        if tick == _inf:
+            self._infinite.append(entry)
+            return
+
+        level = ((tick ^ self._tick).bit_length() - 1) // self._level_bits
+        if level >= self._num_levels:
+            self._overflow.append((tick, entry))
+            return
+
+        index = (tick >> (level * self._level_bits)) & self._level_mask
+        self._levels[level][index].append(entry)
+        self._occupied[level] |= 1 << index
+
+    def _advance(self):
+        # Move the wheel's current tick to the earliest non-empty slot,
+        # cascading its handles to lower levels, until some are due
+        while not self._due:
+            level = next((level for level, occupied in enumerate(self._occupied) if occupied), None)
+
+            if level is None and not self._overflow:
+                return
+
+            if level is None:
+                overflow, self._overflow = self._overflow, []
+                self._tick = min(tick for tick, _ in overflow)
+                for _, entry in overflow:
+                    self._place(entry)
+                continue
+
+            shift = level * self._level_bits
+            occupied = self._occupied[level]
+            index = (occupied & -occupied).bit_length() - 1
+            self._occupied[level] = occupied & (occupied - 1)
+            slots = self._levels[level]
+            entries, slots[index] = slots[index], []
+            self._tick = ((self._tick >> (shift + self._level_bits)) << (shift + self._level_bits)) | (index << shift)
+            for entry in entries:
+                self._place(entry)
+
+
+# The same thresholds as asyncio's own event loop uses to remove cancelled
+# TimerHandles from its heap
+_MIN_SCHEDULED_TIMER_HANDLES = 100
+_MIN_CANCELLED_TIMER_HANDLES_FRACTION = 0.5
+
+
+def _should_compact(num_entries, num_cancelled):
+    return \
+        num_entries > _MIN_SCHEDULED_TIMER_HANDLES and \
+        num_cancelled / num_entries > _MIN_CANCELLED_TIMER_HANDLES_FRACTION
+
+
+def _without_cancelled(entries, cancelling_handle):
+    # The handle being cancelled is not yet flagged as cancelled. The latest
+    # cancelled entry is kept if it's after all live entries, since popping it
+    # moves time forward, which can resolve forwards
+    live = []
+    latest_cancelled = None
+    for entry in entries:
+        handle = entry[2]
+        if handle._cancelled or handle is cancelling_handle:
+            handle._scheduled = False
+            if latest_cancelled is None or entry[:2] > latest_cancelled[:2]:
+                latest_cancelled = entry
+        else:
+            live.append(entry)
+
+    latest_live = max((entry[:2] for entry in live), default=None)
+    keep_latest_cancelled = \
+        latest_cancelled is not None and \
+        (latest_live is None or latest_cancelled[0] > latest_live[0])
+    if keep_latest_cancelled:
+        latest_cancelled[2]._scheduled = _QUEUED
+        live.append(latest_cancelled)
+
+    return live, int(keep_latest_cancelled)
+
+
+_timer_queues = {
+    'heap': _TimerQueue,
+    'wheel': _TimerWheel,
+}
+
+
+class VirtualTimeEventLoop(asyncio.SelectorEventLoop):
+    # An event loop whose time only moves forward when it has nothing ready to
+    # run and would otherwise wait for a callback: time then jumps straight to
+    # the next one. No patching is involved, so unlike FastForward, works with
+    # references to call_later or call_at taken at any point
+
+    def __init__(self):
+        self._virtual_time = 0.0
+        super().__init__(_VirtualTimeSelector(self._jump_to_next_callback))
+
+    def time(self):
+        return self._virtual_time
+
+    def _jump_to_next_callback(self):
+        self._virtual_time = max(self._virtual_time, float(self._scheduled[0]._when))
+
+
+class VirtualTimeEventLoopPolicy(asyncio.DefaultEventLoopPolicy):
+    _loop_factory = VirtualTimeEventLoop
+
+
+class _VirtualTimeSelector(selectors.DefaultSelector):
+    # The loop only passes a positive timeout if it has nothing ready and is
+    # waiting for a callback. Instead of waiting, polls once and if there are
+    # no events, jumps time to that callback
+
+    def __init__(self, on_idle):
+        super().__init__()
+        self._on_idle = on_idle
+
+    def select(self, timeout=None):
+        if timeout is None or timeout <= 0:
+            return super().select(timeout)
+
+        events = super().select(0)
+        if not events:
+            self._on_idle()
+        return events
 
 
 def _set_result_unless_cancelled(future, result):
     if not future.cancelled():
         future.set_result(result)
+
+
+class _SleepHandle():
+    # Used in place of a TimerHandle for patched sleeps: setting the result of
+    # a future doesn't need a copy of the context or exception handling
+
+    __slots__ = ('_when', '_scheduled', '_cancelled', '_future', '_result')
+
+    _callback = _set_result_unless_cancelled
+
+    def __init__(self, when, future, result):
+        self._when = when
+        self._scheduled = False
+        self._cancelled = False
+        self._future = future
+        self._result = result
+
+    def cancel(self, fast_forward):
+        if not self._cancelled:
+            fast_forward._mocked_timer_handle_cancelled(self)
+            self._cancelled = True
+
+    def _run(self):
+        if not self._future.cancelled():
+            self._future.set_result(self._result)
+
+
+class _CompactTimerHandle():
+    # Used in place of a TimerHandle with compact_handles. Has the same public
+    # interface, but not the fields only used for the loop's own timers or in
+    # debug mode, so takes less memory. It isn't a TimerHandle, and isn't
+    # reused, since a handle can be cancelled any time after its callback runs
+
+    __slots__ = ('_when', '_scheduled', '_cancelled', '_callback', '_args', '_loop', '_context')
+
+    def __init__(self, when, callback, args, loop, context):
+        self._when = when
+        self._scheduled = False
+        self._cancelled = False
+        self._callback = callback
+        self._args = args
+        self._loop = loop
+        self._context = context if context is not None else _copy_context()
+
+    def __repr__(self):
+        return '<{} when={} {}{}>'.format(
+            type(self).__name__, self._when, _callback_name(self._callback),
+            ' cancelled' if self._cancelled else '')
+
+    def when(self):
+        return self._when
+
+    def cancelled(self):
+        return self._cancelled
+
+    def get_context(self):
+        return self._context
+
+    def cancel(self):
+        if not self._cancelled:
+            if self._scheduled:
+                self._loop._timer_handle_cancelled(self)
+            self._cancelled = True
+            self._callback = None
+            self._args = None
+
+    def _run(self):
+        try:
+            if self._context is None:
+                self._callback(*self._args)
+            else:
+                self._context.run(self._callback, *self._args)
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except BaseException as exception:
+            self._loop.call_exception_handler({
+                'message': 'Exception in callback {}'.format(_callback_name(self._callback)),
+                'exception': exception,
+                'handle': self,
+            })
+
+
+class _TickHandle():
+    # The entry in the forwards queue for FastForward.ticks, put back in the
+    # queue for each tick
+
+    __slots__ = ('_when', '_scheduled', '_cancelled', '_reached', '_waiter')
+
+    def __init__(self):
+        self._when = None
+        self._scheduled = False
+        self._cancelled = False
+        self._reached = False
+        self._waiter = None
+
+    def _run(self):
+        self._reached = True
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    _callback = _run
+
+
+@types.coroutine
+def _sleep0():
+    yield
+
+
+_get_running_loop = asyncio.events._get_running_loop
@@ -0,0 +1,255 @@
+import argparse
+import asyncio
+import json
+import platform
+import queue
+import random
+import time
+import tracemalloc
+
+import aiofastforward
+
+
+def run_in_new_loop(coro_func):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro_func(loop))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+def bench_queue_put_get(queue_factory, n):
+    loop = asyncio.new_event_loop()
+    handles = [
+        asyncio.TimerHandle(float(i % 1000), lambda: None, (), loop)
+        for i in range(n)
+    ]
+    timer_queue = queue_factory()
+    start = time.perf_counter()
+    for handle in handles:
+        timer_queue.put(handle)
+    for _ in range(n):
+        timer_queue.get()
+    elapsed = time.perf_counter() - start
+    loop.close()
+    return elapsed
+
+
+def bench_timers_scaling(timers, n):
+    # Idle-timer style workload: most timers are cancelled before they fire.
+    # Run in a FastForward so cancelling goes through the queue
+    async def main(loop):
+        with aiofastforward.FastForward(loop, timers=timers) as forward:
+            rand = random.Random(n)
+            handles = [
+                asyncio.TimerHandle(rand.uniform(0, 3600), _noop, (), loop)
+                for _ in range(n)
+            ]
+            timer_queue = forward._callbacks_queue
+
+            start = time.perf_counter()
+            for handle in handles:
+                timer_queue.put(handle)
+            put_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for handle in handles[:n * 9 // 10]:
+                handle.cancel()
+            cancel_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            while timer_queue:
+                timer_queue.get()
+            get_elapsed = time.perf_counter() - start
+
+            return put_elapsed, cancel_elapsed, get_elapsed
+
+    return run_in_new_loop(main)
+
+
+def bench_call_later(n, timers):
+    async def main(loop):
+        with aiofastforward.FastForward(loop, timers=timers):
+            start = time.perf_counter()
+            for i in range(n):
+                loop.call_later(i % 1000, _noop)
+            return time.perf_counter() - start
+
+    return run_in_new_loop(main)
+
+
+def bench_call_at(n, timers):
+    async def main(loop):
+        with aiofastforward.FastForward(loop, timers=timers):
+            start = time.perf_counter()
+            for i in range(n):
+                loop.call_at(i % 1000, _noop)
+            return time.perf_counter() - start
+
+    return run_in_new_loop(main)
+
+
+def bench_schedule_many(n, timers):
+    async def main(loop):
+        with aiofastforward.FastForward(loop, timers=timers) as forward:
+            start = time.perf_counter()
+            forward.schedule_many((i % 1000, _noop, ()) for i in range(n))
+            await forward(0)
+            return time.perf_counter() - start
+
+    return run_in_new_loop(main)
+
+
+def bench_sleeps(n):
+    async def sleeper(i):
+        await asyncio.sleep(i % 100)
+
+    async def main(loop):
+        with aiofastforward.FastForward(loop) as forward:
+            start = time.perf_counter()
+            tasks = [asyncio.ensure_future(sleeper(i)) for i in range(n)]
+            await forward(99)
+            await asyncio.gather(*tasks)
+            return time.perf_counter() - start
+
+    return run_in_new_loop(main)
+
+
+def bench_sleep_memory(n):
+    # Memory allocated per pending sleep, including its task
+    async def main(loop):
+        with aiofastforward.FastForward(loop) as forward:
+            tracemalloc.start()
+            start_memory, _ = tracemalloc.get_traced_memory()
+            start = time.perf_counter()
+            tasks = [asyncio.ensure_future(asyncio.sleep(1)) for _ in range(n)]
+            await forward(0)
+            end_memory, _ = tracemalloc.get_traced_memory()
+            elapsed = time.perf_counter() - start
+            tracemalloc.stop()
+            await forward(1)
+            await asyncio.gather(*tasks)
+            return elapsed, (end_memory - start_memory) / n
+
+    return run_in_new_loop(main)
+
+
+def bench_call_later_memory(n, compact_handles):
+    # Memory allocated per pending callback, including its queue entry
+    async def main(loop):
+        with aiofastforward.FastForward(loop, compact_handles=compact_handles) as forward:
+            tracemalloc.start()
+            start_memory, _ = tracemalloc.get_traced_memory()
+            start = time.perf_counter()
+            for i in range(n):
+                loop.call_later(i + 0.5, _noop)
+            await forward(0)
+            end_memory, _ = tracemalloc.get_traced_memory()
+            elapsed = time.perf_counter() - start
+            tracemalloc.stop()
+            return elapsed, (end_memory - start_memory) / n
+
+    return run_in_new_loop(main)
+
+
+def bench_forward(n, pending, timers):
+    # Callbacks far in the future, so each forward resolves without calling any
+    async def main(loop):
+        with aiofastforward.FastForward(loop, timers=timers) as forward:
+            for _ in range(pending):
+                loop.call_later(10 ** 9, _noop)
+            start = time.perf_counter()
+            for _ in range(n):
+                await forward(1)
+            return time.perf_counter() - start
+
+    return run_in_new_loop(main)
+
+
+def bench_cancel_heavy(n, timers):
+    # Timeouts that are re-armed, as with a per-connection idle timer
+    async def main(loop):
+        with aiofastforward.FastForward(loop, timers=timers) as forward:
+            start = time.perf_counter()
+            handle = loop.call_later(60, _noop)
+            for i in range(n):
+                handle.cancel()
+                handle = loop.call_later(60 + i * 0.001, _noop)
+            await forward(60)
+            return time.perf_counter() - start
+
+    return run_in_new_loop(main)
+
+
+def bench_enter_exit(n):
+    async def main(loop):
+        start = time.perf_counter()
+        for _ in range(n):
+            with aiofastforward.FastForward(loop):
+                pass
+        return time.perf_counter() - start
+
+    return run_in_new_loop(main)
+
+
+def _noop():
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-timers', type=int, default=10 ** 7)
+    parser.add_argument('--output', help='Path to write results to as JSON')
+    args = parser.parse_args()
+
+    results = []
+
+    def report(name, n, elapsed, **params):
+        results.append(dict(name=name, n=n, seconds=elapsed, **params))
+        print('{:<60} {:>10.0f} ops/s {:>10.3f} us/op'.format(
+            ' '.join([name, 'n={}'.format(n)] + ['{}={}'.format(key, value) for key, value in sorted(params.items())]),
+            n / elapsed, elapsed / n * 1e6))
+
+    n = 100000
+    report('queue_put_get', n, bench_queue_put_get(queue.PriorityQueue, n), queue='PriorityQueue')
+    report('queue_put_get', n, bench_queue_put_get(aiofastforward._TimerQueue, n), queue='_TimerQueue')
+    report('sleep', n, bench_sleeps(n))
+    report('enter_exit', n, bench_enter_exit(n))
+    elapsed, bytes_per_sleep = bench_sleep_memory(n)
+    report('sleep_memory', n, elapsed, bytes_per_sleep=round(bytes_per_sleep))
+    for compact_handles in [False, True]:
+        elapsed, bytes_per_timer = bench_call_later_memory(n, compact_handles)
+        report('call_later_memory', n, elapsed, compact_handles=compact_handles, bytes_per_timer=round(bytes_per_timer))
+
+    for timers in sorted(aiofastforward._timer_queues):
+        report('call_later', n, bench_call_later(n, timers), timers=timers)
+        report('call_at', n, bench_call_at(n, timers), timers=timers)
+        report('schedule_many', n, bench_schedule_many(n, timers), timers=timers)
+        report('cancel_heavy', n, bench_cancel_heavy(n, timers), timers=timers)
+        for pending in [1, 1000, 10 ** 6]:
+            if pending <= args.max_timers:
+                report('forward', 1000, bench_forward(1000, pending, timers), timers=timers, pending=pending)
+
+    for scaling_n in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7]:
+        if scaling_n > args.max_timers:
+            print('scaling n={} skipped, since more than --max-timers {}'.format(scaling_n, args.max_timers))
+            continue
+        for timers in sorted(aiofastforward._timer_queues):
+            put_elapsed, cancel_elapsed, get_elapsed = bench_timers_scaling(timers, scaling_n)
+            report('scaling_put', scaling_n, put_elapsed, timers=timers)
+            report('scaling_cancel', scaling_n, cancel_elapsed, timers=timers)
+            report('scaling_get', scaling_n, get_elapsed, timers=timers)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python_version': platform.python_version(),
+                'platform': platform.platform(),
+                'results': results,
+            }, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import asyncio
+
+import pytest
+
+import aiofastforward
+
+try:
+    import pytest_asyncio
+except ImportError:
+    pytest_asyncio = None
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup('aiofastforward')
+    group.addoption(
+        '--aiofastforward-profile', action='store_true', default=False,
+        help='Report the tests that spend the most real time waiting for asyncio.sleep, '
+             'loop.call_later or loop.call_at, outside of aiofastforward.FastForward',
+    )
+    group.addoption(
+        '--aiofastforward-profile-top', type=int, default=20,
+        help='Number of tests to report with --aiofastforward-profile',
+    )
+
+
+def pytest_configure(config):
+    if config.getoption('aiofastforward_profile'):
+        config.pluginmanager.register(_Profiler(config), '_aiofastforward_profiler')
+
+
+# pytest_asyncio.fixture was introduced in pytest-asyncio 0.17, which
+# doesn't support Python 3.6
+if pytest_asyncio is not None and hasattr(pytest_asyncio, 'fixture'):
+
+    @pytest_asyncio.fixture
+    async def fast_forward():
+        with aiofastforward.FastForward(asyncio.get_event_loop()) as forward:
+            yield forward
+
+
+class _Profiler():
+    # Records the intervals between scheduling and calling loop.call_at
+    # callbacks, which includes asyncio.sleep, using the real loop. Intervals
+    # of concurrent waits overlap, so are merged. FastForward patches call_at
+    # on the loop instance, so its callbacks aren't recorded, and callbacks
+    # already due when scheduled, such as its own dispatch, don't wait
+
+    def __init__(self, config):
+        self._config = config
+        self._intervals = {}
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item):
+        original_call_at = asyncio.BaseEventLoop.call_at
+
+        intervals = self._intervals.setdefault(item.nodeid, [])
+
+        def recording_call_at(loop, when, callback, *args, **kwargs):
+            start = loop.time()
+            if when <= start:
+                return original_call_at(loop, when, callback, *args, **kwargs)
+
+            def recording_callback(*callback_args):
+                intervals.append((start, loop.time()))
+                return callback(*callback_args)
+
+            return original_call_at(loop, when, recording_callback, *args, **kwargs)
+
+        asyncio.BaseEventLoop.call_at = recording_call_at
+        try:
+            yield
+        finally:
+            asyncio.BaseEventLoop.call_at = original_call_at
+
+    def pytest_terminal_summary(self, terminalreporter):
+        top = self._config.getoption('aiofastforward_profile_top')
+        waits = sorted(
+            ((nodeid, _merged_length(intervals)) for nodeid, intervals in self._intervals.items() if intervals),
+            key=lambda item: item[1], reverse=True,
+        )
+        terminalreporter.write_sep('=', 'aiofastforward: real time waiting for callbacks')
+        terminalreporter.write_line('{:.2f}s total'.format(sum(wait for _, wait in waits)))
+        for nodeid, wait in waits[:top]:
+            terminalreporter.write_line('{:10.2f}s {}'.format(wait, nodeid))
+
+
+def _merged_length(intervals):
+    total = 0
+    end = None
+    for interval_start, interval_end in sorted(intervals):
+        if end is None or interval_start > end:
+            total += interval_end - interval_start
+            end = interval_end
+        elif interval_end > end:
+            total += interval_end - end
+            end = interval_end
+    return total
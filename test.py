@@ -1,6 +1,15 @@
 import asyncio
+import io
+import json
+import sys
+import time
+import types
 import unittest
+from time import (
+    monotonic,
+)
 from threading import (
+    Event as ThreadEvent,
     Thread,
 )
 from unittest.mock import (
@@ -9,8 +18,12 @@ from unittest.mock import (
     patch,
 )
 
+import pytest
+
 import aiofastforward
 
+pytest_plugins = ['pytester']
+
 
 async def test_call_later_concurrent_called_in_order():
 
@@ -25,6 +38,82 @@ async def test_call_later_concurrent_called_in_order():
         assert callback.mock_calls == [call(0), call(1)]
 
 
+async def test_call_later_many_concurrent_called_in_order():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop) as forward:
+        callback = Mock()
+        for i in range(100):
+            loop.call_later(1, callback, i)
+
+        forward(1)
+        assert callback.mock_calls == [call(i) for i in range(100)]
+
+
+async def test_schedule_many_called_in_order():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop) as forward:
+        callback = Mock()
+        with patch.object(forward, '_original_call_at', wraps=forward._original_call_at) as original_call_at:
+            handles = forward.schedule_many(
+                (2 - (i % 2), callback, (i,))
+                for i in range(6)
+            )
+            loop.call_later(1, callback, 'single')
+        assert original_call_at.call_count == 1
+        assert all(isinstance(handle, asyncio.TimerHandle) for handle in handles)
+        handles[1].cancel()
+
+        await forward(1)
+        assert callback.mock_calls == [call(3), call(5), call('single')]
+        await forward(1)
+        assert callback.mock_calls == [call(3), call(5), call('single'), call(0), call(2), call(4)]
+
+
+async def test_schedule_many_empty():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop) as forward:
+        assert forward.schedule_many([]) == []
+
+
+async def test_call_later_many_schedule_single_run():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop) as forward:
+        callback = Mock()
+        with patch.object(forward, '_original_call_at', wraps=forward._original_call_at) as original_call_at:
+            for i in range(100):
+                loop.call_later(0, callback, i)
+        assert original_call_at.call_count == 1
+
+        await forward(0)
+        assert callback.mock_calls == [call(i) for i in range(100)]
+
+        loop.call_later(0, callback, 100)
+        await forward(0)
+        assert callback.mock_calls == [call(i) for i in range(101)]
+
+
+async def test_call_later_due_called_after_call_soon():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop):
+        callback = Mock()
+        loop.call_later(0, callback, 'timer')
+        loop.call_soon(callback, 'soon')
+
+        for _ in range(3):
+            await asyncio.sleep(0)
+        assert callback.mock_calls == [call('soon'), call('timer')]
+
+
 async def test_call_later_is_cumulative_no_await():
 
     loop = asyncio.get_event_loop()
@@ -112,6 +201,76 @@ async def test_call_later_can_be_cancelled():
         assert callback.mock_calls == []
 
 
+async def test_call_later_cancelled_are_removed():
+
+    loop = asyncio.get_event_loop()
+
+    for timers in ['heap', 'wheel']:
+        with aiofastforward.FastForward(loop, timers=timers) as forward:
+            callback = Mock()
+            handles = [loop.call_later(i, callback, i) for i in range(1000)]
+            for handle in handles[:-10]:
+                handle.cancel()
+            assert len(forward._callbacks_queue) < 100
+
+            await forward(999)
+            assert callback.mock_calls == [call(i) for i in range(990, 1000)]
+
+
+async def test_sleep_cancelled_are_removed():
+
+    loop = asyncio.get_event_loop()
+
+    for timers in ['heap', 'wheel']:
+        with aiofastforward.FastForward(loop, timers=timers) as forward:
+            tasks = [asyncio.ensure_future(asyncio.sleep(i + 1)) for i in range(1000)]
+            await forward(0)
+            assert len(forward._callbacks_queue) == 1000
+
+            for task in tasks[:-10]:
+                task.cancel()
+            await asyncio.gather(*tasks[:-10], return_exceptions=True)
+            assert len(forward._callbacks_queue) < 100
+            assert forward.stats()['timers_cancelled'] == 990
+
+            await forward(1000)
+            await asyncio.gather(*tasks[-10:])
+
+
+async def test_loop_timers_cancelled_are_not_counted():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+    original_cancelled_count = loop._timer_cancelled_count
+
+    handle = loop.call_later(10, callback)
+    with aiofastforward.FastForward(loop, speed=10) as forward:
+        for i in range(50):
+            loop.call_later(50 - i, callback)
+        handle.cancel()
+
+        assert forward.stats()['timers_cancelled'] == 0
+        assert forward._callbacks_queue._cancelled_count == 0
+        assert loop._timer_cancelled_count > original_cancelled_count
+
+
+async def test_call_later_all_cancelled_forward_resolves():
+
+    loop = asyncio.get_event_loop()
+
+    for timers in ['heap', 'wheel']:
+        with aiofastforward.FastForward(loop, timers=timers) as forward:
+            callback = Mock()
+            handles = [loop.call_later(i, callback, i) for i in range(1000)]
+            for handle in handles:
+                handle.cancel()
+            assert len(forward._callbacks_queue) < 100
+
+            await forward(999)
+            assert callback.mock_calls == []
+            assert loop.time() == 999
+
+
 async def test_call_later_handle_is_timerhandle():
 
     loop = asyncio.get_event_loop()
@@ -135,6 +294,19 @@ async def test_call_later_original_restored_on_exception():
     assert loop.call_later == original_call_later
 
 
+async def test_timer_handle_cancelled_original_restored_on_exception():
+
+    loop = asyncio.get_event_loop()
+    original_timer_handle_cancelled = loop._timer_handle_cancelled
+    try:
+        with aiofastforward.FastForward(loop):
+            raise Exception()
+    except BaseException:
+        pass
+
+    assert loop._timer_handle_cancelled == original_timer_handle_cancelled
+
+
 async def test_call_at_concurrent_called_in_order():
 
     loop = asyncio.get_event_loop()
@@ -557,6 +729,53 @@ async def test_sleep_returns_result():
 
         task.cancel()
 
+async def test_run_until_idle_resolves_chain_of_sleeps():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    async def sleeper():
+        await asyncio.sleep(1)
+        callback(0)
+        await asyncio.sleep(2.5)
+        callback(1)
+        loop.call_later(3, callback, 2)
+
+    with aiofastforward.FastForward(loop) as forward:
+        asyncio.ensure_future(sleeper())
+
+        assert await forward.run_until_idle() == 6.5
+        assert callback.mock_calls == [call(0), call(1), call(2)]
+        assert loop.time() == 6.5
+
+        assert await forward.run_until_idle() == 0
+
+
+async def test_run_until_idle_then_forward():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    with aiofastforward.FastForward(loop) as forward:
+        loop.call_later(1, callback, 0)
+        assert await forward.run_until_idle() == 1
+
+        loop.call_later(1, callback, 1)
+        await forward(1)
+        assert callback.mock_calls == [call(0), call(1)]
+        assert loop.time() == 2
+
+
+async def test_sleep_zero_resolves_without_forward():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop):
+        assert await asyncio.sleep(0, result='value') == 'value'
+        assert await asyncio.sleep(-1, result='value') == 'value'
+        assert loop.time() == 0
+
+
 async def test_sleep_original_restored_on_exception():
 
     loop = asyncio.get_event_loop()
@@ -599,6 +818,1108 @@ async def test_sleep_only_patches_specified_loop():
         asyncio.sleep = original_sleep
 
 
+async def test_autojump_sleep_resolves_without_forward():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, autojump=True):
+        await asyncio.sleep(3600)
+        assert loop.time() == 3600
+
+
+async def test_autojump_runs_periodic_task():
+
+    loop = asyncio.get_event_loop()
+    times = []
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(1)
+            times.append(loop.time())
+
+    with aiofastforward.FastForward(loop, autojump=True):
+        task = asyncio.ensure_future(heartbeat())
+        await asyncio.sleep(5.5)
+        assert times == [1, 2, 3, 4, 5]
+        task.cancel()
+
+
+async def test_autojump_wait_for_times_out():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, autojump=True):
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.Event().wait(), 10)
+        assert loop.time() == 10
+
+
+async def test_autojump_resolves_forward():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    with aiofastforward.FastForward(loop, autojump=True) as forward:
+        loop.call_later(1, callback, 0)
+        loop.call_later(3, callback, 1)
+
+        await forward(2)
+        assert loop.time() == 2
+        assert callback.mock_calls == [call(0)]
+
+
+async def test_autojump_with_run_until_idle():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    with aiofastforward.FastForward(loop, autojump=True) as forward:
+        loop.call_later(5, callback)
+
+        assert await forward.run_until_idle() == 5
+        assert callback.call_count == 1
+
+
+async def test_autojump_waits_for_executor_jobs():
+
+    loop = asyncio.get_event_loop()
+    timed_out = Mock()
+
+    with aiofastforward.FastForward(loop, autojump=True):
+        loop.call_later(5, timed_out)
+        await loop.run_in_executor(None, time.sleep, 0.01)
+
+        assert timed_out.call_count == 0
+
+
+async def test_autojump_not_after_exit():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    with aiofastforward.FastForward(loop, autojump=True):
+        loop.call_later(1, callback, 0)
+
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert callback.mock_calls == []
+
+
+async def test_stats():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop) as forward:
+        callback = Mock()
+        loop.call_later(1, callback, 0)
+        loop.call_later(2, callback, 1)
+        handle = loop.call_later(3, callback, 2)
+        handle.cancel()
+        loop.call_later(4, callback, 3)
+
+        await forward(2)
+        await forward(0.5)
+        stats = forward.stats()
+
+    assert stats['timers_scheduled'] == 4
+    assert stats['timers_fired'] == 2
+    assert stats['timers_cancelled'] == 1
+    assert stats['forwards_issued'] == 2
+    assert stats['forwards_resolved'] == 2
+    assert stats['callbacks_queue_size'] == 2
+    assert stats['callbacks_queue_peak_size'] == 4
+    assert stats['forwards_queue_size'] == 0
+    assert stats['forwards_queue_peak_size'] == 1
+    assert stats['runs'] >= 2
+    assert 0 <= stats['noop_runs'] < stats['runs']
+    assert stats['virtual_time'] == 2.5
+    assert stats['real_time'] >= 0
+
+
+def traced_callback():
+    pass
+
+
+async def test_tracer_records_scheduled_cancelled_and_fired():
+
+    loop = asyncio.get_event_loop()
+    tracer = aiofastforward.Tracer()
+
+    with aiofastforward.FastForward(loop, tracer=tracer) as forward:
+        loop.call_later(1, traced_callback)
+        handle = loop.call_later(2, traced_callback)
+        handle.cancel()
+        await forward(1)
+
+    events = [
+        (event['cat'], event['name'], event['ts'])
+        for event in tracer.events
+        if event['name'] == 'test.traced_callback'
+    ]
+    assert events == [
+        ('scheduled', 'test.traced_callback', 0),
+        ('scheduled', 'test.traced_callback', 0),
+        ('cancelled', 'test.traced_callback', 0),
+        ('fired', 'test.traced_callback', 1000000),
+    ]
+    fired = next(event for event in tracer.events if event['cat'] == 'fired')
+    assert fired['ph'] == 'X'
+    assert fired['dur'] >= 0
+
+    f = io.StringIO()
+    tracer.write(f)
+    assert json.loads(f.getvalue())['traceEvents'] == tracer.events
+
+
+async def test_patch_time_time_functions_follow_forward():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, patch_time=True) as forward:
+        wall_time = time.time()
+        assert time.monotonic() == 0
+        assert time.perf_counter() == 0
+        assert monotonic() == 0
+
+        loop.call_later(10, Mock())
+        await forward(10)
+
+        assert time.monotonic() == 10
+        assert time.perf_counter() == 10
+        assert monotonic() == 10
+        assert time.time() == wall_time + 10
+
+    assert monotonic is time.monotonic
+
+
+async def test_patch_time_restores_references_taken_while_patched(monkeypatch):
+
+    loop = asyncio.get_event_loop()
+    module = types.ModuleType('late_module')
+
+    with aiofastforward.FastForward(loop, patch_time=True, real_time_leaks='warn'):
+        monkeypatch.setitem(sys.modules, 'late_module', module)
+        exec('from time import monotonic, perf_counter, sleep', vars(module))
+        assert module.monotonic() == 0
+
+    assert module.monotonic is time.monotonic
+    assert module.perf_counter is time.perf_counter
+    assert module.sleep is time.sleep
+
+
+async def test_patch_time_not_patched_by_default():
+
+    loop = asyncio.get_event_loop()
+    original_monotonic = time.monotonic
+
+    with aiofastforward.FastForward(loop):
+        assert time.monotonic is original_monotonic
+
+
+async def test_real_time_leaks_warn_executor_and_thread_sleep():
+
+    loop = asyncio.get_event_loop()
+
+    def blocking():
+        sum(range(1000000))
+
+    with aiofastforward.FastForward(loop, real_time_leaks='warn'):
+        with pytest.warns(aiofastforward.RealTimeLeakWarning, match='blocking'):
+            await loop.run_in_executor(None, blocking)
+        with pytest.warns(aiofastforward.RealTimeLeakWarning, match='time.sleep') as record:
+            await loop.run_in_executor(None, time.sleep, 0.01)
+        assert len(record) == 1
+
+
+async def test_real_time_leaks_virtual_thread_sleep():
+
+    loop = asyncio.get_event_loop()
+    start = time.monotonic()
+
+    with aiofastforward.FastForward(loop, real_time_leaks='virtual') as forward:
+        sleep = loop.run_in_executor(None, time.sleep, 100)
+        await forward(100)
+        await sleep
+        assert loop.time() == 100
+
+    assert time.monotonic() - start < 50
+
+
+async def test_real_time_leaks_virtual_thread_sleep_released_on_exit():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, real_time_leaks='virtual') as forward:
+        sleep = loop.run_in_executor(None, time.sleep, 100)
+        while forward.stats()['timers_scheduled'] == 0:
+            await asyncio.sleep(0)
+
+    await sleep
+
+
+async def test_real_time_leaks_invalid_raises():
+
+    loop = asyncio.get_event_loop()
+
+    with pytest.raises(ValueError):
+        aiofastforward.FastForward(loop, real_time_leaks='unknown')
+
+
+async def test_timers_wheel_call_later_correct_order():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, timers='wheel') as forward:
+        callback = Mock()
+        delays = [100000, 0.5, 1, 3600, 0.0001, 1, 64, 0.5, 4096.25, 10 ** 12]
+        for i, delay in enumerate(delays):
+            loop.call_later(delay, callback, i)
+
+        await forward(10 ** 12)
+        expected = sorted(range(len(delays)), key=lambda i: delays[i])
+        assert callback.mock_calls == [call(i) for i in expected]
+
+
+async def test_timers_wheel_call_later_can_be_cancelled():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, timers='wheel') as forward:
+        callback = Mock()
+        handle = loop.call_later(1, callback, 0)
+        loop.call_later(2, callback, 1)
+        handle.cancel()
+
+        await forward(1)
+        assert callback.mock_calls == []
+        await forward(1)
+        assert callback.mock_calls == [call(1)]
+
+
+async def test_timers_wheel_sleep_awaiting_forward_blocks_until_time_just_after_sleep():
+
+    loop = asyncio.get_event_loop()
+    at_2 = asyncio.Event()
+    at_3 = asyncio.Event()
+
+    async def sleeper():
+        await asyncio.sleep(1)
+        at_2.set()
+        await asyncio.sleep(1)
+        at_3.set()
+
+    with aiofastforward.FastForward(loop, timers='wheel') as forward:
+        task = asyncio.ensure_future(sleeper())
+
+        await forward(1.5)
+        assert at_2.is_set()
+        assert not at_3.is_set()
+        assert loop.time() == 1.5
+        task.cancel()
+
+
+async def test_timers_unknown_raises():
+
+    loop = asyncio.get_event_loop()
+
+    with pytest.raises(ValueError):
+        aiofastforward.FastForward(loop, timers='unknown')
+
+
+def test_virtual_time_event_loop_sleep_jumps_time():
+
+    loop = aiofastforward.VirtualTimeEventLoop()
+    start = time.monotonic()
+    try:
+        assert loop.run_until_complete(asyncio.sleep(3600, result='value')) == 'value'
+        assert loop.time() == 3600
+    finally:
+        loop.close()
+    assert time.monotonic() - start < 60
+
+
+def test_virtual_time_event_loop_callbacks_in_order():
+
+    loop = aiofastforward.VirtualTimeEventLoop()
+    call_later = loop.call_later
+    callback = Mock()
+    times = []
+
+    async def schedule():
+        call_later(2, callback, 0)
+        loop.call_at(loop.time() + 1, callback, 1)
+        handle = call_later(1.5, callback, 2)
+        handle.cancel()
+        loop.call_later(2, callback, 3)
+        await asyncio.sleep(3)
+        times.append(loop.time())
+
+    try:
+        loop.run_until_complete(schedule())
+    finally:
+        loop.close()
+
+    assert callback.mock_calls == [call(1), call(0), call(3)]
+    assert times == [3]
+
+
+def test_virtual_time_event_loop_wait_for_times_out():
+
+    loop = aiofastforward.VirtualTimeEventLoop()
+
+    async def wait():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(asyncio.Event().wait(), 10)
+
+    try:
+        loop.run_until_complete(wait())
+        assert loop.time() == 10
+    finally:
+        loop.close()
+
+
+def test_virtual_time_event_loop_policy_creates_virtual_time_event_loop():
+
+    loop = aiofastforward.VirtualTimeEventLoopPolicy().new_event_loop()
+    try:
+        assert isinstance(loop, aiofastforward.VirtualTimeEventLoop)
+    finally:
+        loop.close()
+
+
+async def test_clock_shared_between_loops_in_different_threads():
+
+    loop = asyncio.get_event_loop()
+    other_loop = asyncio.new_event_loop()
+    clock = aiofastforward.Clock()
+    calls = []
+    other_entered = ThreadEvent()
+    other_exit = other_loop.create_future()
+
+    def record(name):
+        calls.append((name, clock.time()))
+
+    async def other_main():
+        with aiofastforward.FastForward(other_loop, clock=clock):
+            other_loop.call_later(1, record, 'other-1')
+            other_loop.call_later(3, record, 'other-3')
+            other_loop.call_later(5, record, 'other-5')
+            other_entered.set()
+            await other_exit
+
+    thread = Thread(target=other_loop.run_until_complete, args=(other_main(),))
+    try:
+        with aiofastforward.FastForward(loop, clock=clock) as forward:
+            thread.start()
+            other_entered.wait()
+
+            loop.call_later(2, record, 'this-2')
+            loop.call_later(4, record, 'this-4')
+
+            await forward(3)
+            assert clock.time() == 3
+            assert calls == [('other-1', 1), ('this-2', 2), ('other-3', 3)]
+
+            other_loop.call_soon_threadsafe(other_exit.set_result, None)
+            thread.join()
+    finally:
+        other_loop.close()
+
+
+def test_pytest_plugin_fast_forward_fixture(pytester):
+
+    pytester.makepyfile("""
+        import asyncio
+
+        async def test_sleep(fast_forward):
+            loop = asyncio.get_event_loop()
+            sleep = asyncio.ensure_future(asyncio.sleep(10))
+            await fast_forward(10)
+            await sleep
+            assert loop.time() == 10
+    """)
+    result = pytester.runpytest('-p', 'pytest_aiofastforward', '-o', 'asyncio_mode=auto')
+    result.assert_outcomes(passed=1)
+
+
+def test_pytest_plugin_profile_reports_real_waits(pytester):
+
+    pytester.makepyfile("""
+        import asyncio
+        import aiofastforward
+
+        async def test_short_sleep():
+            await asyncio.sleep(0.01)
+
+        async def test_long_sleep():
+            await asyncio.sleep(0.1)
+
+        async def test_fast_forwarded_sleep():
+            loop = asyncio.get_event_loop()
+            with aiofastforward.FastForward(loop) as forward:
+                sleep = asyncio.ensure_future(asyncio.sleep(10))
+                await forward(10)
+                await sleep
+    """)
+    result = pytester.runpytest(
+        '-p', 'pytest_aiofastforward', '-o', 'asyncio_mode=auto',
+        '--aiofastforward-profile',
+    )
+    result.assert_outcomes(passed=3)
+    result.stdout.fnmatch_lines([
+        '*aiofastforward: real time waiting for callbacks*',
+        '*s total',
+        '*s *test_long_sleep',
+        '*s *test_short_sleep',
+    ])
+    result.stdout.no_fnmatch_line('*test_fast_forwarded_sleep')
+    waits = _profile_waits(result)
+    assert 0.11 <= waits['total'] < 2
+    assert 0.1 <= waits['test_long_sleep'] < 1
+    assert 0.01 <= waits['test_short_sleep'] < waits['test_long_sleep']
+
+
+def test_pytest_plugin_profile_merges_concurrent_waits(pytester):
+
+    pytester.makepyfile("""
+        import asyncio
+
+        async def test_concurrent_sleeps():
+            await asyncio.gather(*(asyncio.sleep(0.05) for _ in range(20)))
+    """)
+    result = pytester.runpytest(
+        '-p', 'pytest_aiofastforward', '-o', 'asyncio_mode=auto',
+        '--aiofastforward-profile',
+    )
+    result.assert_outcomes(passed=1)
+    waits = _profile_waits(result)
+
+    # Summed, the sleeps would be 1 second
+    assert 0.05 <= waits['test_concurrent_sleeps'] < 0.5
+    assert waits['total'] == waits['test_concurrent_sleeps']
+
+
+def _profile_waits(result):
+    # The seconds of each line of the report, keyed on test name or 'total'
+    lines = result.stdout.lines
+    start = next(i for i, line in enumerate(lines) if 'aiofastforward: real time waiting' in line) + 1
+    waits = {}
+    for line in lines[start:]:
+        parts = line.split()
+        if len(parts) != 2 or not parts[0].endswith('s'):
+            break
+        waits[parts[1].rsplit('::', 1)[-1]] = float(parts[0][:-1])
+    return waits
+
+
+async def test_speed_time_moves_with_real_time():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, speed=1000):
+        start_time = loop.time()
+        real_start_time = monotonic()
+        await asyncio.sleep(2)
+        real_elapsed = monotonic() - real_start_time
+
+        assert loop.time() - start_time >= 2
+        assert real_elapsed < 1
+
+
+async def test_speed_call_later_without_forward():
+
+    loop = asyncio.get_event_loop()
+    called = asyncio.Event()
+
+    with aiofastforward.FastForward(loop, speed=1000):
+        loop.call_later(1, called.set)
+        await asyncio.wait_for(called.wait(), 1)
+
+
+async def test_speed_forward_jumps():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    with aiofastforward.FastForward(loop, speed=0.001) as forward:
+        start_time = loop.time()
+        loop.call_later(100, callback)
+        await forward(100)
+
+        assert callback.call_count == 1
+        assert loop.time() - start_time >= 100
+        assert loop.time() - start_time < 101
+
+
+async def test_speed_patch_time_matches_loop_time():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, speed=1000, patch_time=True):
+        await asyncio.sleep(0.5)
+        loop_time = loop.time()
+        monotonic_time = time.monotonic()
+        loop_time_after = loop.time()
+
+        assert loop_time >= 0.5
+        assert loop_time <= monotonic_time <= loop_time_after
+
+
+async def test_speed_invalid_raises():
+
+    loop = asyncio.get_event_loop()
+
+    with pytest.raises(ValueError):
+        aiofastforward.FastForward(loop, speed=0)
+
+
+async def test_recorder_records_and_verifies_schedule():
+
+    loop = asyncio.get_event_loop()
+
+    def callback(_):
+        pass
+
+    async def scenario(recorder):
+        with aiofastforward.FastForward(loop, recorder=recorder) as forward:
+            loop.call_later(1, callback, 'a')
+            loop.call_later(2, callback, 'b')
+            await forward(2)
+
+    recorder = aiofastforward.Recorder()
+    await scenario(recorder)
+    f = io.BytesIO()
+    recorder.write(f)
+
+    assert [(when, name.rsplit('.', 1)[-1]) for when, name, _ in recorder.events] == [
+        (1.0, 'callback'), (2.0, 'callback'), (2.0, '_set_result_unless_cancelled'),
+    ]
+
+    f.seek(0)
+    await scenario(aiofastforward.Recorder(expected=f))
+
+
+async def test_recorder_verifies_callable_instances():
+
+    loop = asyncio.get_event_loop()
+
+    class Callback():
+        def __call__(self):
+            pass
+
+    async def scenario(recorder):
+        with aiofastforward.FastForward(loop, recorder=recorder) as forward:
+            loop.call_later(1, Callback())
+            await forward(1)
+
+    recorder = aiofastforward.Recorder()
+    await scenario(recorder)
+    f = io.BytesIO()
+    recorder.write(f)
+
+    assert recorder.events[0][1] == 'test.test_recorder_verifies_callable_instances.<locals>.Callback'
+
+    f.seek(0)
+    await scenario(aiofastforward.Recorder(expected=f))
+
+
+async def test_recorder_verify_fails_on_first_difference():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    recorder = aiofastforward.Recorder()
+    with aiofastforward.FastForward(loop, recorder=recorder) as forward:
+        loop.call_later(1, callback, 'a')
+        await forward(1)
+    f = io.BytesIO()
+    recorder.write(f)
+
+    f.seek(0)
+    with pytest.raises(aiofastforward.ScheduleMismatchError, match='Event 0 differs'):
+        with aiofastforward.FastForward(loop, recorder=aiofastforward.Recorder(expected=f)) as forward:
+            loop.call_later(1, callback, 'b')
+            await forward(1)
+
+    assert callback.call_count == 1
+
+
+async def test_recorder_verify_fails_on_missing_events():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    recorder = aiofastforward.Recorder()
+    with aiofastforward.FastForward(loop, recorder=recorder) as forward:
+        loop.call_later(1, callback)
+        await forward(1)
+    f = io.BytesIO()
+    recorder.write(f)
+
+    f.seek(0)
+    with pytest.raises(aiofastforward.ScheduleMismatchError, match='Only 0 of the 2'):
+        with aiofastforward.FastForward(loop, recorder=aiofastforward.Recorder(expected=f)):
+            pass
+
+
+async def test_resource_limits_concurrency_and_queues_in_order():
+
+    loop = asyncio.get_event_loop()
+    completed = []
+
+    async def client(i, database):
+        await database()
+        completed.append((i, loop.time()))
+
+    with aiofastforward.FastForward(loop) as forward:
+        database = aiofastforward.Resource(0.5, concurrency=2)
+        tasks = [asyncio.ensure_future(client(i, database)) for i in range(5)]
+        await forward(1.5)
+        await asyncio.gather(*tasks)
+
+        assert completed == [(0, 0.5), (1, 0.5), (2, 1.0), (3, 1.0), (4, 1.5)]
+        stats = database.stats()
+        assert stats['operations'] == 5
+        assert stats['peak_in_use'] == 2
+        assert stats['peak_waiting'] == 3
+        assert stats['total_wait_time'] == 0.5 + 0.5 + 1.0
+        assert stats['max_wait_time'] == 1.0
+        assert stats['busy_time'] == 2.5
+
+
+async def test_resource_replaces_async_function_and_returns_result():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop) as forward:
+        query = aiofastforward.Resource(lambda: 0.25, result='row')
+        task = asyncio.ensure_future(query('SELECT 1', timeout=5))
+        await forward(0.25)
+
+        assert await task == 'row'
+
+
+async def test_resource_cancelled_waiter_does_not_hold_slot():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop) as forward:
+        database = aiofastforward.Resource(1, concurrency=1)
+        first = asyncio.ensure_future(database())
+        second = asyncio.ensure_future(database())
+        third = asyncio.ensure_future(database())
+        await forward(0)
+        second.cancel()
+        await forward(2)
+        await first
+        await third
+
+        assert second.cancelled()
+        assert database.stats()['operations'] == 2
+        assert database.stats()['in_use'] == 0
+
+
+async def test_network_echo_with_latency():
+
+    loop = asyncio.get_event_loop()
+
+    async def echo(reader, writer):
+        writer.write(await reader.readexactly(5))
+        await writer.drain()
+        writer.close()
+
+    with aiofastforward.FastForward(loop) as forward:
+        network = aiofastforward.Network(latency=0.1)
+        server = await network.start_server(echo, 'db', 5432)
+
+        async def client():
+            reader, writer = await network.open_connection('db', 5432)
+            writer.write(b'hello')
+            response = await reader.read()
+            writer.close()
+            return response, loop.time()
+
+        task = asyncio.ensure_future(client())
+        await forward.run_until_idle()
+        server.close()
+        await server.wait_closed()
+
+        # Handshake round trip, then request and response
+        assert await task == (b'hello', 0.4)
+
+
+async def test_network_bandwidth_serialises_writes():
+
+    loop = asyncio.get_event_loop()
+    received = []
+
+    async def receive(reader, writer):
+        while True:
+            data = await reader.read(1000)
+            if not data:
+                break
+            received.append((len(data), loop.time()))
+
+    with aiofastforward.FastForward(loop) as forward:
+        network = aiofastforward.Network(latency=0.01, bandwidth=1000)
+        await network.start_server(receive, 'host', 1)
+
+        async def send():
+            _, writer = await network.open_connection('host', 1)
+            writer.write(b'a' * 500)
+            writer.write(b'b' * 1000)
+            writer.write_eof()
+
+        asyncio.ensure_future(send())
+        await forward.run_until_idle()
+
+        assert received == [(500, 0.02 + 0.5 + 0.01), (1000, 0.02 + 1.5 + 0.01)]
+
+
+async def test_network_drain_waits_for_bandwidth():
+
+    loop = asyncio.get_event_loop()
+    received = []
+
+    async def receive(reader, writer):
+        received.append(await reader.read())
+
+    with aiofastforward.FastForward(loop) as forward:
+        network = aiofastforward.Network(bandwidth=1000)
+        await network.start_server(receive, 'host', 1)
+
+        async def send():
+            _, writer = await network.open_connection('host', 1)
+            writer.transport.set_write_buffer_limits(high=2000)
+            for _ in range(100):
+                writer.write(b'a' * 1000)
+                await writer.drain()
+                assert writer.transport.get_write_buffer_size() <= 2000 + 1000
+            sent = loop.time()
+            writer.close()
+            return sent
+
+        sender = asyncio.ensure_future(send())
+        await forward.run_until_idle()
+
+        assert 97 <= await sender <= 100
+        assert received == [b'a' * 100000]
+        assert loop.time() == 100
+
+
+async def test_network_jitter_and_loss_keep_order_and_are_seeded():
+
+    loop = asyncio.get_event_loop()
+
+    async def run(seed):
+        received = []
+
+        async def receive(reader, writer):
+            received.append(await reader.read())
+
+        with aiofastforward.FastForward(loop) as forward:
+            network = aiofastforward.Network(latency=0.05, jitter=0.2, loss=0.3, seed=seed)
+            await network.start_server(receive, 'host', 1)
+
+            async def send():
+                _, writer = await network.open_connection('host', 1)
+                for i in range(100):
+                    writer.write(b'%d,' % i)
+                writer.close()
+
+            asyncio.ensure_future(send())
+            elapsed = await forward.run_until_idle()
+
+        return received, elapsed
+
+    (received, elapsed), (received_again, elapsed_again) = await run(1), await run(1)
+
+    assert received == [b''.join(b'%d,' % i for i in range(100))]
+    assert (received, elapsed) == (received_again, elapsed_again)
+
+
+async def test_network_connection_refused():
+
+    with pytest.raises(ConnectionRefusedError):
+        await aiofastforward.Network().open_connection('host', 1)
+
+
+async def test_ticks_yields_at_each_interval():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+    samples = []
+
+    with aiofastforward.FastForward(loop) as forward:
+        loop.call_later(1.5, callback)
+        loop.call_later(3, callback)
+        async for now in forward.ticks(1, count=3):
+            samples.append((now, loop.time(), callback.call_count))
+
+        assert samples == [(1, 1, 0), (2, 2, 1), (3, 3, 2)]
+
+
+async def test_ticks_reuses_one_forward_entry():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop) as forward:
+        loop.call_later(10 ** 9, lambda: None)
+        num_ticks = 0
+        async for _ in forward.ticks(1):
+            num_ticks += 1
+            if num_ticks == 100000:
+                break
+
+        assert loop.time() == 100000
+        assert forward.stats()['forwards_issued'] == 100000
+        assert forward.stats()['forwards_queue_peak_size'] == 1
+
+
+async def test_ticks_waits_for_later_sleeps():
+
+    loop = asyncio.get_event_loop()
+    woken = []
+
+    async def sleeper():
+        for _ in range(3):
+            await asyncio.sleep(1)
+            woken.append(loop.time())
+
+    with aiofastforward.FastForward(loop) as forward:
+        sleeper_task = asyncio.ensure_future(sleeper())
+        await forward(0)
+        samples = [(now, len(woken)) async for now in forward.ticks(0.5, count=6)]
+        await sleeper_task
+
+        assert samples == [(0.5, 0), (1.0, 0), (1.5, 1), (2.0, 1), (2.5, 2), (3.0, 2)]
+
+
+async def test_until_returns_time_predicate_first_true():
+
+    loop = asyncio.get_event_loop()
+    received = []
+
+    async def producer():
+        for i in range(10):
+            await asyncio.sleep(0.7)
+            received.append(i)
+
+    with aiofastforward.FastForward(loop) as forward:
+        asyncio.ensure_future(producer())
+        reached = await forward.until(lambda: len(received) == 3)
+
+        assert reached == pytest.approx(2.1)
+        assert loop.time() == reached
+        assert received == [0, 1, 2]
+
+
+async def test_until_predicate_already_true_does_not_move_time():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    with aiofastforward.FastForward(loop) as forward:
+        loop.call_later(1, callback)
+
+        assert await forward.until(lambda: True) == 0
+        assert callback.call_count == 0
+
+
+async def test_until_limit_raises_timeout():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    with aiofastforward.FastForward(loop) as forward:
+        loop.call_later(1, callback)
+        loop.call_later(5, callback)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await forward.until(lambda: callback.call_count == 2, limit=2)
+
+        assert callback.call_count == 1
+        assert loop.time() == 1
+
+
+async def test_until_no_callbacks_raises_timeout():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop) as forward:
+        with pytest.raises(asyncio.TimeoutError):
+            await forward.until(lambda: False)
+
+
+async def test_call_periodic_calls_every_interval():
+
+    loop = asyncio.get_event_loop()
+    times = []
+
+    with aiofastforward.FastForward(loop) as forward:
+        timer = forward.call_periodic(1, lambda: times.append(loop.time()))
+        await forward(3.5)
+        timer.cancel()
+        loop.call_later(10, lambda: None)
+        await forward(10)
+
+        assert times == [1, 2, 3]
+        assert timer.cancelled()
+
+
+async def test_call_periodic_skippable_skips_to_last_period():
+
+    loop = asyncio.get_event_loop()
+    heartbeats = []
+    flushes = []
+
+    with aiofastforward.FastForward(loop) as forward:
+        forward.call_periodic(1, lambda missed: heartbeats.append((loop.time(), missed)),
+                              skippable=True, pass_missed=True)
+        forward.call_periodic(1, lambda: flushes.append(loop.time()), skippable=True)
+        await forward(7 * 24 * 60 * 60)
+
+        assert heartbeats == [(7 * 24 * 60 * 60, 7 * 24 * 60 * 60 - 1)]
+        assert flushes == [7 * 24 * 60 * 60]
+        assert forward.stats()['periods_skipped'] == 2 * (7 * 24 * 60 * 60 - 1)
+
+
+async def test_call_periodic_skippable_not_skipped_past_other_callbacks():
+
+    loop = asyncio.get_event_loop()
+    calls = []
+
+    with aiofastforward.FastForward(loop) as forward:
+        forward.call_periodic(1, lambda missed: calls.append(('periodic', loop.time(), missed)),
+                              skippable=True, pass_missed=True)
+        forward.call_periodic(4, lambda: calls.append(('every 4', loop.time())))
+        loop.call_later(5.5, lambda: calls.append(('once', loop.time())))
+        await forward(10)
+
+        assert calls == [
+            ('periodic', 3, 2),
+            ('every 4', 4),
+            ('periodic', 5, 1),
+            ('once', 5.5),
+            ('periodic', 7, 1),
+            ('every 4', 8),
+            ('periodic', 10, 2),
+        ]
+
+
+async def test_call_periodic_forwards_resolve_at_each_step():
+
+    loop = asyncio.get_event_loop()
+    calls = []
+
+    with aiofastforward.FastForward(loop) as forward:
+        forward.call_periodic(1, lambda missed: calls.append((loop.time(), missed)),
+                              skippable=True, pass_missed=True)
+        await forward(2.5)
+        assert loop.time() == 2.5
+        await forward(2.5)
+
+        assert calls == [(2, 1), (5, 2)]
+
+
+async def test_compact_handles_call_cancel_and_when():
+
+    loop = asyncio.get_event_loop()
+    callback = Mock()
+
+    with aiofastforward.FastForward(loop, compact_handles=True) as forward:
+        handle_1 = loop.call_later(1, callback, 1)
+        handle_2 = loop.call_at(2, callback, 2)
+        handle_3 = loop.call_later(3, callback, 3)
+        handle_2.cancel()
+
+        assert handle_1.when() == 1
+        assert not handle_1.cancelled()
+        assert handle_2.cancelled()
+
+        await forward(3)
+        assert callback.mock_calls == [call(1), call(3)]
+        assert forward.stats()['timers_cancelled'] == 1
+
+
+async def test_compact_handles_exception_passed_to_handler():
+
+    loop = asyncio.get_event_loop()
+    exception_handler = Mock()
+    loop.set_exception_handler(exception_handler)
+    exception = Exception()
+
+    def raise_exception():
+        raise exception
+
+    try:
+        with aiofastforward.FastForward(loop, compact_handles=True) as forward:
+            handle = loop.call_later(1, raise_exception)
+            callback = Mock()
+            loop.call_later(1, callback)
+            await forward(1)
+
+        assert exception_handler.call_args[0][1]['exception'] is exception
+        assert exception_handler.call_args[0][1]['handle'] is handle
+        assert callback.call_count == 1
+    finally:
+        loop.set_exception_handler(None)
+
+
+async def test_detect_deadlocks_raises_if_forward_can_never_complete():
+
+    loop = asyncio.get_event_loop()
+
+    async def sleeper():
+        await asyncio.sleep(1)
+
+    with aiofastforward.FastForward(loop, detect_deadlocks=True) as forward:
+        asyncio.ensure_future(sleeper())
+
+        with pytest.raises(aiofastforward.ForwardDeadlockError, match='Forward to 2.0 can never complete: time is 1.0'):
+            await forward(2)
+
+        assert forward.stats()['forwards_queue_size'] == 0
+
+
+async def test_detect_deadlocks_with_run_until_idle():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, detect_deadlocks=True) as forward:
+        forward_5 = forward(5)
+
+        assert await forward.run_until_idle() == 0
+        with pytest.raises(aiofastforward.ForwardDeadlockError):
+            await forward_5
+
+
+async def test_detect_deadlocks_ticks_raises():
+
+    loop = asyncio.get_event_loop()
+
+    with aiofastforward.FastForward(loop, detect_deadlocks=True) as forward:
+        loop.call_later(1, lambda: None)
+
+        with pytest.raises(aiofastforward.ForwardDeadlockError):
+            async for _ in forward.ticks(1):
+                pass
+
+
+async def test_detect_deadlocks_waits_for_executor_jobs():
+
+    loop = asyncio.get_event_loop()
+
+    async def sleep_after_executor():
+        await loop.run_in_executor(None, time.sleep, 0.2)
+        await asyncio.sleep(1)
+
+    with aiofastforward.FastForward(loop, detect_deadlocks=True) as forward:
+        task = asyncio.ensure_future(sleep_after_executor())
+        await forward(1)
+        await task
+
+
 # contextvars introduced in Python 3.7
 try:
     import contextvars